@@ -6,12 +6,10 @@ import json
 import tempfile
 import posixpath
 
-import yaml
-
 from data import mirror
 from version import get_version_str
 from backend.content import get_content
-from backend.catalog import CATALOGS, get_catalogs
+from backend.catalog import CATALOGS, get_catalogs, dump_catalog
 
 ansiblecube_path = "/var/lib/ansible/local"
 # update CATALOGS to include our in-qemu local URL
@@ -178,6 +176,11 @@ def build_extra_vars(
     return extra_vars, secret_keys
 
 
+def has_custom_branding(logo=None, favicon=None, css=None):
+    """ whether any of the branding files is set """
+    return any([item is not None for item in (logo, favicon, css)])
+
+
 def run_phase_one(
     machine, extra_vars, secret_keys, homepage, logo=None, favicon=None, css=None
 ):
@@ -191,23 +194,15 @@ def run_phase_one(
     # copy branding files if set
     branding = {"favicon.png": favicon, "logo.png": logo, "style.css": css}
 
-    has_custom_branding = False
     for fname, item in [(k, v) for k, v in branding.items() if v is not None]:
-        has_custom_branding = True
         machine.put_file(item, "/tmp/{}".format(fname))
 
-    extra_vars.update({"has_custom_branding": has_custom_branding})
+    extra_vars.update({"has_custom_branding": has_custom_branding(logo, favicon, css)})
 
     # save YAML catalogs into local files inside VM for use by ideascube
     for index, catalog in enumerate(CATALOGS):
         with tempfile.NamedTemporaryFile(suffix=".yml", delete=False) as fd:
-            yaml.safe_dump(
-                get_catalogs(machine._logger)[index],
-                fd,
-                default_flow_style=False,
-                allow_unicode=True,
-                encoding="utf-8",
-            )
+            fd.write(dump_catalog(get_catalogs(machine._logger)[index]).encode("utf-8"))
             machine.put_file(fd.name, catalog["local_url"].replace("file://", ""))
             try:
                 os.unlink(fd.name)
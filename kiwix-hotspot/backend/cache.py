@@ -2,46 +2,133 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import os
+import json
 import shutil
+import hashlib
+import datetime
+import concurrent.futures
 
 from util import human_readable_size
 from backend.content import CONTENTS
-from backend.content import get_content
-from backend.catalog import get_catalogs
+from backend.content import get_content, get_prepared_master_fname
+from backend.download import unzip_file
+from backend.catalog import get_package_record_by_fname
 from util import get_cache, get_folder_size, get_free_space_in_dir, get_checksum
+from util import get_cache_fnames, update_checksums_index, get_folder_checksum
+from util import get_indexed_checksum, read_cache_usage, record_cache_usage
 
+ANALYSIS_WORKERS = os.cpu_count() or 1  # cache files analyzed concurrently
+
+
+def file_matches(fpath, checksum, size, quick=False):
+    """ whether the file is the expected one (same size and checksum)
+
+        in quick mode, the checksums index is trusted and a file of the
+        expected size is considered a match: it is only hashed if its
+        expected size is unknown """
+    if size is not None and os.path.getsize(fpath) != size:
+        return False
+    if quick:
+        indexed = get_indexed_checksum(fpath)
+        if indexed is not None:
+            return indexed == checksum
+        if size is not None:
+            return True
+    return get_checksum(fpath) == checksum
 
-def package_is_latest_version(fpath, fname, logger):
-    """ whether a package (ZIM or ZIP) is in the current catalog """
 
-    for catalog in get_catalogs(logger):
-        for (package_id, package) in catalog["all"].items():
-            package.update({"ext": "zip" if package["type"] != "zim" else "zim"})
-            package.update({"langid": package.get("langid") or package_id})
-            rfname = "package_{langid}-{version}.{ext}".format(**package)
-            if rfname == fname and get_checksum(fpath) == package["sha256sum"]:
-                return "{ext}: {fname}".format(
-                    fname=package["langid"], ext=package["ext"].upper()
-                )
+def package_is_latest_version(fpath, fname, logger, quick=False):
+    """ whether a package (ZIM or ZIP) is in the current catalog """
+    package = get_package_record_by_fname(logger, fname)
+    if package is not None and file_matches(
+        fpath, package.sha256sum, package.size, quick
+    ):
+        return "{ext}: {fname}".format(fname=package.langid, ext=package.ext.upper())
     return False
 
 
-def is_latest_version(fpath, fname, logger):
-    """ whether the filename is a usable content """
+def is_latest_version(fpath, fname, logger, quick=False):
+    """ whether the filename is a usable content
+
+        quick: match on name and size, see file_matches() """
+
+    if fname == get_prepared_master_fname():
+        return "prepared hotspot_master_image"
+
+    if fname.startswith(get_setup_snapshot_prefix()):
+        return "configured image snapshot"
 
-    if fname.startswith("package_"):
-        return package_is_latest_version(fpath, fname, logger)
+    package = package_is_latest_version(fpath, fname, logger, quick)
+    if package:
+        return package
 
     for key, content in CONTENTS.items():
         if not content["name"] == fname:
             continue
 
-        if get_checksum(fpath) == content["checksum"]:
+        if file_matches(fpath, content["checksum"], content.get("archive_size"), quick):
             return key
 
     return False
 
 
+def prepare_master(master, archive_fpath, cache_folder, logger):
+    """ path to the decompressed master image in cache
+
+        master is extracted from its ZIP archive if not already present """
+    fpath = os.path.join(cache_folder, get_prepared_master_fname(master))
+    if os.path.exists(fpath):
+        logger.std("Reusing prepared master image {}".format(fpath))
+        record_cache_usage(fpath)
+        return fpath
+
+    # extract to a temp file so an interrupted extraction is never reused
+    tmp_fpath = "{}.tmp".format(fpath)
+    unzip_file(
+        archive_fpath=archive_fpath,
+        src_fname=master["name"].replace(".zip", ""),
+        build_folder=cache_folder,
+        dest_fpath=tmp_fpath,
+        logger=logger,
+    )
+    os.replace(tmp_fpath, fpath)
+    record_cache_usage(fpath)
+    logger.std("Prepared master image saved to {}".format(fpath))
+    return fpath
+
+
+def get_setup_snapshot_prefix(master=None):
+    """ file name prefix of configured image snapshots for a master """
+    if master is None:
+        master = get_content("hotspot_master_image")
+    return "snapshot_{}_".format(master["checksum"][:8])
+
+
+def get_setup_snapshot_path(cache_folder, master, extra_vars, paths):
+    """ path of the snapshot of an image configured with those parameters
+
+        snapshot is identified by a hash of the master's checksum,
+        the extra_vars and the content of supplied files or folders """
+    h = hashlib.sha256()
+    h.update(master["checksum"].encode("utf-8"))
+    h.update(json.dumps(extra_vars, sort_keys=True).encode("utf-8"))
+    for path in paths:
+        if path is None:
+            checksum = "-"
+        elif os.path.isdir(path):
+            checksum = get_folder_checksum(path)
+        else:
+            checksum = get_checksum(path)
+        h.update(checksum.encode("utf-8"))
+
+    return os.path.join(
+        cache_folder,
+        "{prefix}{key}.img".format(
+            prefix=get_setup_snapshot_prefix(master), key=h.hexdigest()[:16]
+        ),
+    )
+
+
 def get_cache_file_details(logger, cache_folder, fname):
     """ analyzed cache file details (dict) """
     fpath = os.path.join(cache_folder, fname)
@@ -53,7 +140,7 @@ def get_cache_file_details(logger, cache_folder, fname):
         alien = True
     if isdir:
         alien = True  # our cache contains only files
-    latest = is_latest_version(fpath, fname, logger)
+    latest = is_latest_version(fpath, fname, logger, quick=True)
 
     return {
         "fname": fname,
@@ -66,16 +153,32 @@ def get_cache_file_details(logger, cache_folder, fname):
 
 
 def get_analyzed_cache_files(logger, cache_folder):
-    """ generator for the detailed file dict of cache files """
-    for fname in os.listdir(cache_folder):
-        yield get_cache_file_details(logger, cache_folder, fname)
+    """ list of the detailed file dict of cache files (sorted by name)
+
+        files are analyzed concurrently (hashing releases the GIL)
+        and the number of analyzed files is reported as it goes """
+    fnames = get_cache_fnames(cache_folder)
+    cfiles = []
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=ANALYSIS_WORKERS
+    ) as executor:
+        futures = [
+            executor.submit(get_cache_file_details, logger, cache_folder, fname)
+            for fname in fnames
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            cfiles.append(future.result())
+            logger.flash("analyzed {}/{} files".format(len(cfiles), len(fnames)))
+    if fnames:
+        logger.std("")  # leave the flashed progress line
+    return sorted(cfiles, key=lambda cfile: cfile["fname"])
 
 
 def get_cache_size_and_free_space(build_folder, cache_folder):
     """ shortcut to query both cache folder size and build-dir free space """
     return (
         get_folder_size(cache_folder),
-        len(os.listdir(cache_folder)),
+        len(get_cache_fnames(cache_folder)),
         get_free_space_in_dir(cache_folder),
     )
 
@@ -162,6 +265,8 @@ def reset_cache(logger, build_folder, cache_folder, **kwargs):
             logger.err("Unable to move back your master file into fresh cache.")
             logger.err("Please find your master at: {}".format(tmp_master_fpath))
             return 1
+        # checksum was just verified ; no need to compute it again
+        update_checksums_index(master_fpath, master["checksum"])
 
     logger.std("-------------")
     display_cache_and_free_space(
@@ -200,6 +305,123 @@ def clean_cache(logger, build_folder, cache_folder, **kwargs):
     return 0
 
 
+def get_allocated_size(fpath):
+    """ bytes actually allocated on disk for a file (holes excluded) """
+    stat = os.stat(fpath)
+    if hasattr(stat, "st_blocks"):
+        return stat.st_blocks * 512
+    return stat.st_size  # no st_blocks on windows
+
+
+def get_cache_allocated_size(cache_folder):
+    """ bytes allocated on disk for all files in the cache folder """
+    total = 0
+    for dirpath, dirnames, fnames in os.walk(cache_folder):
+        for fname in fnames:
+            total += get_allocated_size(os.path.join(dirpath, fname))
+    return total
+
+
+def evict_cache(logger, build_folder, cache_folder, **kwargs):
+    """ remove least recently used files until cache is within its quota
+
+        quota is a maximum cache size (`max_size`) and/or a minimum free
+        space (`min_free`) in bytes. files are ordered by their last use
+        (as recorded in cache) or modification date if never recorded.
+        files in `keep` (names) and folders are never removed.
+
+        sizes are allocated ones (sparse files) and free space is queried
+        after each removal as cloned files share their extents """
+    max_size, min_free = kwargs.get("max_size"), kwargs.get("min_free")
+    keep = kwargs.get("keep") or []
+    logger.step("Enforcing cache quota for: {}".format(cache_folder))
+
+    initial_size, initial_free = display_cache_and_free_space(
+        logger, build_folder, cache_folder
+    )
+    cache_size = get_cache_allocated_size(cache_folder)
+    free_space = initial_free
+
+    def over_quota():
+        return (max_size is not None and cache_size > max_size) or (
+            min_free is not None and free_space < min_free
+        )
+
+    if not over_quota():
+        logger.std("Cache is within quota.")
+        return 0
+    logger.std("-------------")
+
+    usage = read_cache_usage(cache_folder)
+    candidates = []
+    for fname in get_cache_fnames(cache_folder):
+        fpath = os.path.join(cache_folder, fname)
+        if fname in keep or os.path.isdir(fpath):
+            continue
+        last_used = usage.get(fname) or os.path.getmtime(fpath)
+        candidates.append((last_used, fname, get_allocated_size(fpath)))
+
+    for last_used, fname, size in sorted(candidates):
+        if not over_quota():
+            break
+        logger.std(
+            "EVICTING `{f}` ({s}, last used {d})... ".format(
+                f=fname,
+                s=human_readable_size(size),
+                d=datetime.datetime.fromtimestamp(last_used).strftime("%c"),
+            ),
+            end="",
+        )
+        try:
+            os.unlink(os.path.join(cache_folder, fname))
+        except Exception as exp:
+            logger.err("FAILED ({}).".format(exp))
+        else:
+            logger.succ("OK.")
+            cache_size -= size
+            free_space = get_free_space_in_dir(cache_folder)
+
+    logger.std("-------------")
+    display_cache_and_free_space(
+        logger, build_folder, cache_folder, initial_size, initial_free
+    )
+    cache_size = get_cache_allocated_size(cache_folder)
+    free_space = get_free_space_in_dir(cache_folder)
+    if over_quota():
+        logger.err("Unable to bring cache within quota: remaining files are needed.")
+        return 1
+    return 0
+
+
+def verify_cache(logger, build_folder, cache_folder, **kwargs):
+    """ check all cache files against their expected checksums
+
+        uses the checksums index for unchanged files unless `full` is set
+        in which case every file is re-hashed (and the index refreshed) """
+    logger.step("Verifying cache content for: {}".format(cache_folder))
+    logger.std("-------------")
+
+    nb_ok = 0
+    for fname in sorted(get_cache_fnames(cache_folder)):
+        fpath = os.path.join(cache_folder, fname)
+        if os.path.isdir(fpath):
+            continue
+
+        logger.std("{}... ".format(fname), end="")
+        if kwargs.get("full"):
+            get_checksum(fpath, force=True)
+        latest = is_latest_version(fpath, fname, logger)
+        if latest:
+            nb_ok += 1
+            logger.succ("OK ({}).".format(latest))
+        else:
+            logger.err("NOT USABLE (obsolete, damaged or alien).")
+
+    logger.std("-------------")
+    logger.std("{} usable file(s) in cache".format(nb_ok))
+    return 0
+
+
 def list_cache_files(logger, build_folder, cache_folder, **kwargs):
     """ colored list of all files in cache with legend (to Keep or to Remove) """
 
@@ -2,13 +2,17 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import os
+import json
+import pickle
+import types
 import random
-import shutil
-import tempfile
+import collections
+import collections.abc
 
-import yaml
+import requests
 
-from backend.download import download_file
+from util import get_prefs_path, yaml_load, yaml_dump
+from backend.download import get_proxies
 
 CATALOGS = [
     {
@@ -19,6 +23,199 @@ CATALOGS = [
 ]
 
 YAML_CATALOGS = None
+CATALOG_TIMEOUT = 30  # seconds to wait for the catalog server
+COMPILED_FORMAT = 2  # compiled catalogs of another format are rebuilt
+RECORD_KEYS = ["type", "url", "sha256sum", "size"]  # required for a record
+
+# normalized (immutable) package details, indexed by id and filename
+PackageRecord = collections.namedtuple(
+    "PackageRecord",
+    ["id", "langid", "version", "type", "ext", "url", "sha256sum", "size", "fname"],
+)
+
+
+def get_catalog_paths(catalog):
+    """ paths of the cached YAML, its HTTP validators and compiled catalog
+
+        catalogs are cached next to the preferences file """
+    prefix = os.path.join(
+        os.path.dirname(get_prefs_path()),
+        "kiwix-hotspot-catalog-{}".format(catalog["name"]),
+    )
+    return {
+        "yaml": prefix + ".yml",
+        "meta": prefix + ".meta.json",
+        "compiled": prefix + ".pickle",
+    }
+
+
+def read_catalog_meta(paths):
+    """ HTTP validators (etag, last_modified) of the cached YAML """
+    try:
+        with open(paths["meta"], "r") as fp:
+            return json.load(fp)
+    except Exception:
+        return {}
+
+
+def write_file(fpath, content, mode="wb"):
+    """ atomically write content to fpath """
+    with open(fpath + ".tmp", mode) as fp:
+        fp.write(content)
+    os.replace(fpath + ".tmp", fpath)
+
+
+class LazyPackages(collections.abc.Mapping):
+    """ read-only mapping of package id to package entry
+
+        entries are kept pickled and only materialized (as fresh dicts)
+        when accessed: most runs only use the few selected packages.
+
+        records and fnames are read-only indexes of PackageRecord
+        by package id and by cache filename """
+
+    def __init__(self, entries, records):
+        self.entries = entries  # package id: pickled entry
+        self.records = types.MappingProxyType(records)
+        fnames = {}
+        for record in records.values():
+            fnames[record.fname] = record
+            # former naming of packages in cache
+            fnames[
+                "package_{langid}-{version}.{ext}".format(**record._asdict())
+            ] = record
+        self.fnames = types.MappingProxyType(fnames)
+
+    def __getitem__(self, package_id):
+        return pickle.loads(self.entries[package_id])
+
+    def __contains__(self, package_id):
+        return package_id in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def get_lazy_catalog(compiled):
+    """ catalog dict (from compiled) with its packages as LazyPackages """
+    catalog = dict(compiled["catalog"])
+    catalog["all"] = LazyPackages(compiled["packages"], compiled["records"])
+    return catalog
+
+
+def get_package_record(package_id, entry):
+    """ normalized PackageRecord for a catalog entry (None if malformed) """
+    try:
+        if any([entry.get(key) is None for key in RECORD_KEYS]):
+            return None
+    except AttributeError:  # not a dict
+        return None
+    ext = "zip" if entry["type"] != "zim" else "zim"
+    langid = entry.get("langid") or package_id
+    return PackageRecord(
+        id=package_id,
+        langid=langid,
+        version=entry.get("version"),
+        type=entry["type"],
+        ext=ext,
+        url=entry["url"],
+        sha256sum=entry["sha256sum"],
+        size=entry["size"],
+        fname="{langid}.{ext}".format(langid=langid, ext=ext),
+    )
+
+
+def compile_catalog(paths, meta, logger):
+    """ parse cached YAML and store it as a quick-loading pickle
+
+        each package entry is pickled separately to be loaded lazily.
+        a normalized record of each package is built for quick lookups:
+        malformed entries are skipped (logged) """
+    with open(paths["yaml"], "r") as fp:
+        catalog = yaml_load(fp)
+    packages = catalog.pop("all", None) or {}
+    records = {}
+    for package_id, entry in packages.items():
+        record = get_package_record(package_id, entry)
+        if record is None:
+            logger.err("Skipping malformed catalog entry: {}".format(package_id))
+            continue
+        records[package_id] = record
+    compiled = {
+        "format": COMPILED_FORMAT,
+        "meta": meta,
+        "packages": {
+            package_id: pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+            for package_id, entry in packages.items()
+        },
+        "records": records,
+        "catalog": catalog,  # other top-level keys
+    }
+    write_file(paths["compiled"], pickle.dumps(compiled, pickle.HIGHEST_PROTOCOL))
+    return get_lazy_catalog(compiled)
+
+
+def load_cached_catalog(paths, logger):
+    """ cached catalog, from compiled version if it matches the YAML """
+    meta = read_catalog_meta(paths)
+    try:
+        with open(paths["compiled"], "rb") as fp:
+            compiled = pickle.load(fp)
+        if compiled.get("format") == COMPILED_FORMAT and compiled["meta"] == meta:
+            return get_lazy_catalog(compiled)
+    except Exception:
+        pass
+
+    logger.std("compiling cached catalog {}".format(paths["yaml"]))
+    return compile_catalog(paths, meta, logger)
+
+
+def fetch_catalog(catalog, logger):
+    """ loaded (yaml) catalog, revalidating the cached copy (ETag/Last-Modified)
+
+        cached copy is used as-is if the server can't be reached """
+    paths = get_catalog_paths(catalog)
+    meta = read_catalog_meta(paths)
+    # cached copy must be from the same URL
+    is_cached = os.path.exists(paths["yaml"]) and meta.get("url") == catalog["url"]
+    if not is_cached:
+        meta = {}
+
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        resp = requests.get(
+            catalog["url"],
+            headers=headers,
+            proxies=get_proxies(),
+            timeout=CATALOG_TIMEOUT,
+        )
+    except requests.RequestException as exp:
+        if not is_cached:
+            raise
+        logger.std("unable to reach catalog ({}), using cached copy".format(exp))
+        return load_cached_catalog(paths, logger)
+
+    if resp.status_code == 304 and is_cached:
+        logger.std("catalog {} is up to date".format(catalog["name"]))
+        return load_cached_catalog(paths, logger)
+    resp.raise_for_status()
+
+    meta = {
+        "url": catalog["url"],
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+    }
+    write_file(paths["yaml"], resp.content)
+    write_file(paths["meta"], json.dumps(meta), mode="w")
+    return compile_catalog(paths, meta, logger)
 
 
 def fetch_catalogs(logger):
@@ -26,17 +223,13 @@ def fetch_catalogs(logger):
     catalogs = []
     logger.std("downloading catalogs...")
     try:
-        tmp_dir = tempfile.mkdtemp()
-
         for catalog in CATALOGS:
-            tmp_fpath = os.path.join(tmp_dir, "{}.catalog".format(catalog["name"]))
-            dlf = download_file(catalog.get("url"), tmp_fpath, logger, debug=False)
-            if dlf.successful:
-                with open(tmp_fpath, "r") as fp:
-                    catalogs.append(yaml.load(fp.read()))
-                os.unlink(tmp_fpath)
-            else:
-                raise ValueError("Unable to download {}".format(catalog.get("url")))
+            try:
+                catalogs.append(fetch_catalog(catalog, logger))
+            except Exception as exp:
+                raise ValueError(
+                    "Unable to download {}: {}".format(catalog.get("url"), exp)
+                )
 
             # ensure the content is readable (prevent incorrect encoding)
             entry = catalogs[-1]["all"][random.choice(list(catalogs[-1]["all"].keys()))]
@@ -55,14 +248,21 @@ def fetch_catalogs(logger):
                     logger.err("Catalog format is not valid")
                     catalogs.pop()  # remove catalog from list
                     break
-
-        shutil.rmtree(tmp_dir, ignore_errors=True)
     except Exception as exp:
         logger.err("Exception while downloading/parsing catalogs: {}".format(exp))
         return None
     return catalogs if len(catalogs) else None
 
 
+def dump_catalog(catalog, stream=None, **kwargs):
+    """ YAML representation of a (lazy) catalog, materializing all packages
+
+        kwargs are passed to the YAML dumper, overriding our defaults """
+    options = {"default_flow_style": False, "allow_unicode": True}
+    options.update(kwargs)
+    return yaml_dump(dict(catalog, all=dict(catalog["all"].items())), stream, **options)
+
+
 def get_catalogs(logger):
     """ cached-shortcut to YAML_CATALOGS """
     global YAML_CATALOGS
@@ -73,5 +273,21 @@ def get_catalogs(logger):
 
 def get_package(logger, package_id):
     for catalog in get_catalogs(logger):
-        if package_id in catalog["all"].keys():
+        if package_id in catalog["all"]:
             return catalog["all"][package_id]
+
+
+def get_package_record_by_id(logger, package_id):
+    """ PackageRecord of a package from its id (None if not in catalogs) """
+    for catalog in get_catalogs(logger) or []:
+        record = catalog["all"].records.get(package_id)
+        if record is not None:
+            return record
+
+
+def get_package_record_by_fname(logger, fname):
+    """ PackageRecord of a package from its cache filename (None if unknown) """
+    for catalog in get_catalogs(logger) or []:
+        record = catalog["all"].fnames.get(fname)
+        if record is not None:
+            return record
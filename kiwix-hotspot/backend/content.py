@@ -2,16 +2,35 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import os
+import sys
 import json
-import shutil
+import time
+import errno
+import queue
+import ctypes
 import itertools
+import concurrent.futures
 
 import requests
 
 from data import content_file, mirror
-from backend.catalog import get_catalogs
+from backend.catalog import get_package_record_by_id
 from backend.download import get_content_cache, unarchive
-from util import get_temp_folder, get_checksum, ONE_GiB, ONE_MiB, CLILogger
+from backend import exfat
+from util import get_checksum, human_readable_size, ONE_GiB, ONE_MiB, CLILogger
+
+COPY_CONCURRENCY = 2  # number of projects copied onto data partition at once
+COPY_CHUNK_SIZE = 2 ** 30  # max bytes per in-kernel copy call (keeps it cancellable)
+COPY_BUFFER_SIZE = 16 * ONE_MiB  # userspace copy buffer
+# errors meaning a copy method is not supported between those files
+UNSUPPORTED_COPY_ERRNOS = (
+    errno.ENOSYS,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+    errno.ENOTSUP,
+)
 
 # prepare CONTENTS from JSON file
 with open(content_file, "r") as fp:
@@ -27,6 +46,13 @@ def get_content(key):
     return CONTENTS.get(key)
 
 
+def get_prepared_master_fname(master=None):
+    """ cache file name of the decompressed version of a master image """
+    if master is None:
+        master = get_content("hotspot_master_image")
+    return "prepared_{}.img".format(master["checksum"][:16])
+
+
 def isremote(path_or_url):
     return path_or_url.startswith("http")
 
@@ -221,58 +247,39 @@ def get_aflatoun_contents(languages=[]):
 
 def get_package_content(package_id):
     """ content-like dict for packages (zim file or static site) """
-    for catalog in get_catalogs(CLILogger()):
-        try:
-            package = catalog["all"][package_id]
-            package.update({"ext": "zip" if package["type"] != "zim" else "zim"})
-            package.update({"langid": package.get("langid") or package_id})
-            return {
-                "url": package["url"],
-                "name": "{langid}.{ext}".format(**package),
-                "checksum": package["sha256sum"],
-                "archive_size": package["size"],
-                # add a 10% margin for non-zim (zip file mostly)
-                "expanded_size": package["size"] * 1.1
-                if package["type"] != "zim"
-                else package["size"],
-            }
-        except KeyError:
-            continue
+    package = get_package_record_by_id(CLILogger(), package_id)
+    if package is None:
+        return None
+    return {
+        "url": package.url,
+        "name": package.fname,
+        "checksum": package.sha256sum,
+        "archive_size": package.size,
+        # add a 10% margin for non-zim (zip file mostly)
+        "expanded_size": package.size * 1.1 if package.type != "zim" else package.size,
+    }
 
 
 def get_packages_contents(packages=[]):
     """ ideacube: ZIM file or ZIP file for each package """
-    return [
-        get_package_content(package)
-        for package in packages
-        if get_package_content(package) is not None
-    ]
+    contents = [get_package_content(package) for package in packages]
+    return [content for content in contents if content is not None]
 
 
-def extract_and_move(content, cache_folder, root_path, final_path, logger):
+def extract_and_move(content, cache_folder, final_path, logger):
     """ extract compressed archive into mount-point
 
-        moves resulting file or folder to desired location """
+        useful content (folder_name if specified) is streamed straight
+        to its final location """
 
     # retrieve archive path
     archive_fpath = get_content_cache(content, cache_folder, True)
 
     logger.std("Extracting {src} to {dst}".format(src=archive_fpath, dst=final_path))
 
-    # extract to a temp folder on root_path
-    extract_folder = get_temp_folder(root_path)
-    unarchive(archive_fpath, extract_folder, logger)
-
-    # move useful content to final path
-    useful_path = (
-        os.path.join(extract_folder, content["folder_name"])
-        if "folder_name" in content.keys()
-        else extract_folder
+    unarchive(
+        archive_fpath, final_path, logger, strip_folder=content.get("folder_name")
     )
-    shutil.move(useful_path, final_path)
-
-    # remove temp dir
-    shutil.rmtree(extract_folder, ignore_errors=True)
 
 
 def copy(content, cache_folder, final_path, logger):
@@ -284,7 +291,127 @@ def copy(content, cache_folder, final_path, logger):
     logger.std("Copying {src} to {dst}".format(src=archive_fpath, dst=final_path))
 
     # move useful content to final path
-    shutil.copy(archive_fpath, final_path)
+    copy_file(archive_fpath, final_path, logger)
+
+
+def copy_file(src_fpath, dest_fpath, logger):
+    """ copy a file using the fastest method available, logging throughput
+
+        tries in-kernel copies (copy_file_range, sendfile) first then falls
+        back to a large-buffer copy. destination is preallocated.
+        destinations within an ExFATWriter are written directly to its image """
+    size = os.path.getsize(src_fpath)
+    started_on = time.time()
+    target = exfat.get_writer(dest_fpath)
+    if target is not None:
+        writer, relpath = target
+        engine = writer.copy_file(src_fpath, relpath)
+    else:
+        engine = copy_to_file(src_fpath, dest_fpath, size)
+
+    duration = time.time() - started_on
+    logger.std(
+        "Copied {name} ({size}) in {duration:.1f}s ({speed}/s) using {engine}".format(
+            name=os.path.basename(dest_fpath),
+            size=human_readable_size(size),
+            duration=duration,
+            speed=human_readable_size(size / duration if duration else size),
+            engine=engine,
+        )
+    )
+
+
+def copy_to_file(src_fpath, dest_fpath, size):
+    """ copy src_fpath to a regular dest_fpath, returning the engine used """
+    with open(src_fpath, "rb") as src, open(dest_fpath, "wb") as dest:
+        src_fd, dest_fd = src.fileno(), dest.fileno()
+        if size:
+            preallocate(dest_fd, size)
+
+        copied = 0
+        engine = None
+        for method in (copy_with_copy_file_range, copy_with_sendfile, copy_with_buffer):
+            try:
+                copied = method(src_fd, dest_fd, copied, size)
+            except OSError as exp:
+                # method unsupported for those files: try next one from offset
+                if exp.errno not in UNSUPPORTED_COPY_ERRNOS:
+                    raise
+                continue
+            if copied >= size:
+                engine = method.__name__.replace("copy_with_", "")
+                break
+        if copied < size:
+            raise IOError("{} was not fully copied".format(src_fpath))
+    return engine
+
+
+def preallocate(fd, size):
+    """ reserve size bytes for a file, if the filesystem supports it natively
+
+        uses fallocate(2) directly as posix_fallocate falls back to writing
+        zeros on filesystems without support (FUSE exFAT): data would then be
+        written twice. returns whether space was reserved """
+    if sys.platform != "linux":
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = libc.fallocate64
+    except (OSError, AttributeError):
+        return False
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    if fallocate(fd, 0, 0, size) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err == errno.ENOSPC:
+        raise OSError(err, os.strerror(err))
+    return False  # EOPNOTSUPP: not supported by filesystem
+
+
+def copy_with_copy_file_range(src_fd, dest_fd, offset, size):
+    """ in-kernel copy (reflink on supporting filesystems) """
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range not available")
+    while offset < size:
+        copied = os.copy_file_range(
+            src_fd, dest_fd, min(size - offset, COPY_CHUNK_SIZE), offset, offset
+        )
+        if not copied:
+            break
+        offset += copied
+    return offset
+
+
+def copy_with_sendfile(src_fd, dest_fd, offset, size):
+    """ in-kernel copy to any file (linux) """
+    if not hasattr(os, "sendfile") or sys.platform != "linux":
+        raise OSError(errno.ENOSYS, "sendfile to file not available")
+    os.lseek(dest_fd, offset, os.SEEK_SET)
+    while offset < size:
+        copied = os.sendfile(
+            dest_fd, src_fd, offset, min(size - offset, COPY_CHUNK_SIZE)
+        )
+        if not copied:
+            break
+        offset += copied
+    return offset
+
+
+def copy_with_buffer(src_fd, dest_fd, offset, size):
+    """ userspace copy using a large buffer """
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dest_fd, offset, os.SEEK_SET)
+    while offset < size:
+        read = os.readv(src_fd, [view])
+        if not read:
+            break
+        written = 0
+        while written < read:
+            written += os.write(dest_fd, view[written:read])
+        offset += read
+    return offset
 
 
 def run_edupi_actions(
@@ -297,7 +424,6 @@ def run_edupi_actions(
     extract_and_move(
         content=get_alien_content(resources_path),
         cache_folder=cache_folder,
-        root_path=mount_point,
         final_path=os.path.join(mount_point, "edupi_resources"),
         logger=logger,
     )
@@ -310,7 +436,7 @@ def run_nomad_actions(cache_folder, mount_point, logger, enable=False):
 
     nomad_apk = get_content("nomad_apk")
     nomad_folder = os.path.join(mount_point, "nomad")
-    os.makedirs(nomad_folder, exist_ok=True)
+    exfat.makedirs(nomad_folder)
     copy(
         content=nomad_apk,
         cache_folder=cache_folder,
@@ -326,7 +452,7 @@ def run_mathews_actions(cache_folder, mount_point, logger, enable=False):
 
     mathews_apk = get_content("mathews_apk")
     mathews_folder = os.path.join(mount_point, "mathews")
-    os.makedirs(mathews_folder, exist_ok=True)
+    exfat.makedirs(mathews_folder)
     copy(
         content=mathews_apk,
         cache_folder=cache_folder,
@@ -356,7 +482,6 @@ def run_kalite_actions(cache_folder, mount_point, logger, languages=[]):
         extract_and_move(
             content=videos,
             cache_folder=cache_folder,
-            root_path=mount_point,
             final_path=os.path.join(mount_point, videos["folder_name"]),
             logger=logger,
         )
@@ -374,7 +499,6 @@ def run_wikifundi_actions(cache_folder, mount_point, logger, languages=[]):
         extract_and_move(
             content=content,
             cache_folder=cache_folder,
-            root_path=mount_point,
             final_path=os.path.join(mount_point, lang_key),
             logger=logger,
         )
@@ -400,7 +524,6 @@ def run_aflatoun_actions(cache_folder, mount_point, logger, languages=[]):
     extract_and_move(
         content=get_content("aflatoun_content"),
         cache_folder=cache_folder,
-        root_path=mount_point,
         final_path=os.path.join(mount_point, "aflatoun_content"),
         logger=logger,
     )
@@ -411,7 +534,7 @@ def run_packages_actions(cache_folder, mount_point, logger, packages=[]):
 
     # ensure packages folder exists: must macth `zim_path` in ansiblecube
     packages_folder = os.path.join(mount_point, "packages")
-    os.makedirs(packages_folder, exist_ok=True)
+    exfat.makedirs(packages_folder)
 
     for package in packages:
         content = get_package_content(package)
@@ -421,7 +544,164 @@ def run_packages_actions(cache_folder, mount_point, logger, packages=[]):
         package_fpath = get_content_cache(content, cache_folder, True)
 
         # copy to the packages folder
-        shutil.copy(package_fpath, os.path.join(packages_folder, content["name"]))
+        copy_file(package_fpath, os.path.join(packages_folder, content["name"]), logger)
+
+
+# run_actions callbacks which handle each item of a list kwarg independently
+SPLITTABLE_ACTIONS = {
+    run_packages_actions: "packages",
+    run_kalite_actions: "languages",
+    run_wikifundi_actions: "languages",
+}
+
+
+def get_collection_tasks(collection):
+    """ independent tasks for the collection's actions
+
+        returns a list of (name, get_content_callback, run_actions_callback,
+        kwargs) like the collection but with splittable projects split into
+        one task per package or language. largest tasks come first """
+    tasks = []
+    for category, content_dl_cb, content_run_cb, cb_kwargs in collection:
+        key = SPLITTABLE_ACTIONS.get(content_run_cb)
+        if key is None:
+            tasks.append((category, content_dl_cb, content_run_cb, cb_kwargs))
+            continue
+        for item in cb_kwargs[key]:
+            item_kwargs = dict(cb_kwargs)
+            item_kwargs[key] = [item]
+            tasks.append(
+                (
+                    "{cat} ({item})".format(cat=category, item=item),
+                    content_dl_cb,
+                    content_run_cb,
+                    item_kwargs,
+                )
+            )
+
+    def get_size(task):
+        return sum([c["expanded_size"] for c in task[1](**task[3])])
+
+    return sorted(tasks, key=get_size, reverse=True)
+
+
+def run_collection_actions(
+    collection,
+    cache_folder,
+    mount_point,
+    logger,
+    concurrency=COPY_CONCURRENCY,
+    ready_contents=None,
+):
+    """ run the actions of all projects in collection onto mount_point
+
+        up to `concurrency` tasks (see get_collection_tasks) run at once so
+        that CPU-bound extractions overlap with disk-bound copies.
+        progress is reported on expanded_size of completed tasks.
+
+        ready_contents: queue.Queue receiving names of contents as they land
+        in cache, then None once all are (or an exception if downloads
+        failed). a task starts as soon as all its contents are ready.
+        all contents are considered in cache if not specified.
+
+        scheduling stops on first failure which is raised once running
+        tasks are completed """
+
+    tasks = get_collection_tasks(collection)
+    concurrency = max([1, min([concurrency, len(tasks)])])
+
+    # (task, names of its contents, expanded size)
+    pending = []
+    for task in tasks:
+        contents = task[1](**task[3])
+        pending.append(
+            (
+                task,
+                set([content["name"] for content in contents]),
+                sum([content["expanded_size"] for content in contents]),
+            )
+        )
+
+    if ready_contents is None:
+        available = set(itertools.chain.from_iterable([p[1] for p in pending]))
+        events = queue.Queue()
+        downloads_over = True
+    else:
+        available = set()
+        events = ready_contents  # also receives our completed futures
+        downloads_over = False
+
+    def run_task(name, content_run_cb, cb_kwargs):
+        logger.step("Processing {name}".format(name=name))
+        content_run_cb(
+            cache_folder=cache_folder,
+            mount_point=mount_point,
+            logger=logger,
+            **cb_kwargs
+        )
+
+    total_size = sum([entry[2] for entry in pending])
+    futures = {}
+    running = 0
+    waiting = False  # whether all tasks are waiting for downloads
+    processed = 0
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            # start all tasks whose contents are in cache
+            for entry in list(pending):
+                task, names, _ = entry
+                if error is None and names <= available:
+                    pending.remove(entry)
+                    name, _, content_run_cb, cb_kwargs = task
+                    future = executor.submit(run_task, name, content_run_cb, cb_kwargs)
+                    futures[future] = entry
+                    running += 1
+                    future.add_done_callback(events.put)
+
+            if not running and (downloads_over or error is not None or not pending):
+                break
+            if not running and not waiting:
+                logger.std(
+                    "Waiting for downloads ({} tasks pending)".format(len(pending))
+                )
+            waiting = not running
+
+            item = events.get()
+            if item is None:
+                downloads_over = True
+                continue
+            if isinstance(item, concurrent.futures.Future):
+                running -= 1
+                if item.cancelled():
+                    continue
+                exp = item.exception()
+            elif isinstance(item, Exception):
+                downloads_over = True
+                exp = item
+            else:
+                available.add(item)
+                continue
+
+            if exp is not None:
+                if error is None:
+                    error = exp
+                # prevent pending tasks from starting
+                for other in futures.keys():
+                    other.cancel()
+                continue
+
+            processed += futures[item][2]
+            logger.progress(processed, total_size or 1)
+
+    if error is not None:
+        raise error
+    if pending:
+        raise IOError(
+            "Contents missing for: {}".format(
+                ", ".join([task[0] for task, _, _ in pending])
+            )
+        )
 
 
 def content_is_cached(content, cache_folder, check_sum=False):
@@ -481,13 +761,22 @@ def get_required_image_size(collection):
     return required_size + ONE_MiB * 256  # make sure we have some free space
 
 
-def get_required_building_space(collection, cache_folder, image_size=None):
+def get_required_building_space(
+    collection, cache_folder, image_size=None, reuse_master=False
+):
     """ total required space to host downlaods and image """
 
     # the master image
-    # we neglect the master's expanded size as it is going to be moved
-    # to the image path and resized in-place (never reduced)
-    base_image_size = get_content("hotspot_master_image").get("archive_size")
+    # we neglect the master's expanded size as it is extracted directly
+    # into the image file (never reduced)
+    master = get_content("hotspot_master_image")
+    base_image_size = master.get("archive_size")
+
+    # unless we're to keep a decompressed master in cache (if not already)
+    if reuse_master and not os.path.exists(
+        os.path.join(cache_folder, get_prepared_master_fname(master))
+    ):
+        base_image_size += master.get("expanded_size")
 
     # the created image
     if image_size is None:
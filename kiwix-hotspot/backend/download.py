@@ -4,20 +4,28 @@
 import os
 import re
 import sys
-import time
 import shutil
+import tarfile
 import zipfile
+import threading
 import subprocess
+import concurrent.futures
 
 import requests
 
 from data import data_dir, http_proxy_test_url, https_proxy_test_url
-from util import get_checksum, get_cache, get_prefs
-from backend.util import subprocess_pretty_check_call, startup_info_args
+from util import get_checksum, get_cache, get_prefs, human_readable_size
+from util import update_checksums_index, record_cache_usage
+from backend.util import startup_info_args
+from backend.util import write_sparse, wait_for_file_release
+from backend.parallel_bz2 import ParallelBZ2Reader
+from backend import exfat
 
 PROXIES = None
 FAILURE_RETRIES = 6
-szip_exe = os.path.join(data_dir, "7za.exe")
+DOWNLOAD_CONCURRENCY = 3  # number of aria2c processes running at once
+EXTRACT_BUFFER_SIZE = 8 * 2 ** 20  # write buffer for extracted files
+PYTHON_PARALLEL_BZ2 = "python-parallel-bz2"
 
 if sys.platform == "win32":
     aria2_exe = os.path.join(data_dir, "aria2c.exe")
@@ -73,10 +81,11 @@ class RequestedFile(object):
         self.status = status
 
     @classmethod
-    def from_download(cls, url, fpath, downloaded_size):
+    def from_download(cls, url, fpath, downloaded_size, checksum=None):
         rf = cls(url, fpath)
         rf.set(cls.DOWNLOADED)
         rf.downloaded_size = downloaded_size
+        rf.checksum = checksum
         return rf
 
     @classmethod
@@ -117,7 +126,9 @@ class RequestedFile(object):
         )
 
 
-def download_file(url, fpath, logger, checksum=None, debug=False):
+def download_file(
+    url, fpath, logger, checksum=None, debug=False, max_speed=None, on_progress=None
+):
 
     """ download an URL into a named path and reports progress to logger
 
@@ -128,7 +139,15 @@ def download_file(url, fpath, logger, checksum=None, debug=False):
 
         supports metalink. if link is metalink, downloads both then replace
         actual target (aria2 doesn't allow setting target for metalink
-        as it can be multiple files) """
+        as it can be multiple files)
+
+        checksum (SHA-256) is verified by aria2c while downloading so
+        the fresh file is recorded in the checksums index without reading it
+        again. metalinks are verified using the hashes they provide.
+
+        max_speed: download speed limit in bytes per second
+        on_progress: callback receiving (downloaded_size, total_size) on
+                     each summary instead of displaying it on the logger """
 
     output_dir, fname = os.path.split(fpath)
     args = [aria2_exe, "--dir={}".format(output_dir), "--out={}".format(fname)]
@@ -147,9 +166,17 @@ def download_file(url, fpath, logger, checksum=None, debug=False):
         "--log-level=error",
         "--console-log-level=error",
         "--summary-interval=1",  # display a line with progress every X seconds
-        "--human-readable={}".format(str(logger.on_tty).lower()),
+        "--human-readable={}".format(
+            str(logger.on_tty and on_progress is None).lower()
+        ),
         "--ca-certificate={}".format(os.path.join(data_dir, "ca-certificates.crt")),
     ]
+    if max_speed:
+        args += ["--max-overall-download-limit={}".format(int(max_speed))]
+    # let aria2c hash the data (metalinks carry their own checksums)
+    verify_checksum = checksum is not None and not is_metalink(url)
+    if verify_checksum:
+        args += ["--checksum=sha-256={}".format(checksum)]
     # zip* files might send incorrect gzip header and get auto-extracted by aria2
     if not fname.endswith("zip"):
         args += ["--http-accept-gzip=true"]
@@ -161,7 +188,7 @@ def download_file(url, fpath, logger, checksum=None, debug=False):
     if debug:
         logger.std(" ".join(args))
 
-    if not logger.on_tty:
+    if not logger.on_tty and on_progress is None:
         logger.ascii_progressbar(0, 100)
 
     metalink_target = None
@@ -169,7 +196,19 @@ def download_file(url, fpath, logger, checksum=None, debug=False):
         line = line.strip()
         # [#915371 5996544B/90241109B(6%) CN:4 DL:1704260B ETA:49s]
         if line.startswith("[#") and line.endswith("]"):  # quick check, no re
-            if logger.on_tty:
+            if on_progress is not None:
+                try:
+                    on_progress(
+                        *[
+                            int(x)
+                            for x in re.search(
+                                r"\s([0-9]+)B\/([0-9]+)B", line
+                            ).groups()
+                        ]
+                    )
+                except Exception:
+                    pass
+            elif logger.on_tty:
                 logger.flash(line + "                    ")
             else:
                 try:
@@ -208,7 +247,7 @@ def download_file(url, fpath, logger, checksum=None, debug=False):
 
     if metalink_target is not None and metalink_target != fpath:
         logger.std(".. mv {src} {dst}".format(src=metalink_target, dst=fpath))
-        time.sleep(5)
+        wait_for_file_release(metalink_target, logger)
         os.replace(metalink_target, fpath)
     else:
         logger.std(
@@ -217,10 +256,20 @@ def download_file(url, fpath, logger, checksum=None, debug=False):
             )
         )
 
-    return RequestedFile.from_download(url, fpath, os.path.getsize(fpath))
+    if verify_checksum:
+        update_checksums_index(fpath, checksum)
+
+    return RequestedFile.from_download(url, fpath, os.path.getsize(fpath), checksum)
 
 
-def download_if_missing(url, fpath, logger, checksum=None):
+def is_metalink(url):
+    """ whether an URL targets a metalink file """
+    return url.endswith(".meta4") or url.endswith(".metalink")
+
+
+def download_if_missing(
+    url, fpath, logger, checksum=None, max_speed=None, on_progress=None
+):
     """ returns local file if existing and matching sum otherwise download """
 
     # file already downloaded
@@ -233,7 +282,15 @@ def download_if_missing(url, fpath, logger, checksum=None):
     elif os.path.exists(fpath):
         return RequestedFile.from_disk(url, fpath)
 
-    return download_file(url, fpath, logger, checksum, debug=True)
+    return download_file(
+        url,
+        fpath,
+        logger,
+        checksum,
+        debug=True,
+        max_speed=max_speed,
+        on_progress=on_progress,
+    )
 
 
 def test_connection(proxies=None):
@@ -253,106 +310,322 @@ def get_content_cache(content, folder, is_cache_folder=False):
     return os.path.join(cache_folder, content.get("name"))
 
 
-def download_content(content, logger, build_folder):
-    """ download or retrieve an item from contents """
-    return download_if_missing(
+def download_content(content, logger, build_folder, max_speed=None, on_progress=None):
+    """ download or retrieve an item from contents
+
+        its last use is recorded for cache eviction """
+    rf = download_if_missing(
         url=content.get("url"),
         fpath=get_content_cache(content, build_folder),
         logger=logger,
         checksum=content.get("checksum"),
+        max_speed=max_speed,
+        on_progress=on_progress,
     )
+    if rf.successful:
+        record_cache_usage(rf.fpath)
+    return rf
+
+
+def download_contents(
+    contents,
+    logger,
+    build_folder,
+    concurrency=DOWNLOAD_CONCURRENCY,
+    bandwidth=None,
+    on_progress=None,
+    on_complete=None,
+    stop_event=None,
+):
+    """ download or retrieve several contents at once
+
+        largest contents are started first. at most `concurrency` aria2c
+        processes run in parallel, equally sharing the `bandwidth` cap
+        (bytes per second, unlimited if None).
+        combined progress of all transfers is reported to on_progress
+        (numerator, denominator) or logger.progress.
+        on_complete(content, RequestedFile) is called as each one completes
+
+        scheduling stops on first failure or once stop_event (threading.Event)
+        is set. running transfers are completed
+
+        returns a list of (content, RequestedFile) tuples in completion order """
+
+    contents = sorted(contents, key=lambda c: c["archive_size"], reverse=True)
+    total_size = sum([c["archive_size"] for c in contents])
+    concurrency = max([1, min([concurrency, len(contents)])])
+    max_speed = bandwidth // concurrency if bandwidth else None
+
+    lock = threading.Lock()
+    retrieved = [0] * len(contents)  # bytes retrieved for each content
+    reported = [None]  # last reported percentage (limits logger updates)
+    if on_progress is None:
+        on_progress = logger.progress
+
+    def report(index, downloaded_size):
+        with lock:
+            retrieved[index] = min([downloaded_size, contents[index]["archive_size"]])
+            percentage = int(sum(retrieved) * 100 / total_size) if total_size else 100
+            if percentage != reported[0]:
+                reported[0] = percentage
+                on_progress(sum(retrieved), total_size)
+
+    def retrieve(index, content):
+        if stop_event is not None and stop_event.is_set():
+            raise IOError("Download of {} cancelled".format(content["name"]))
+        logger.std(
+            "Retrieving {name} ({size})".format(
+                name=content["name"], size=human_readable_size(content["archive_size"])
+            )
+        )
+        return download_content(
+            content,
+            logger,
+            build_folder,
+            max_speed=max_speed,
+            on_progress=lambda downloaded, total: report(index, downloaded),
+        )
 
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(retrieve, index, content): index
+            for index, content in enumerate(contents)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            index = futures[future]
+            if future.cancelled():
+                continue
+            try:
+                rf = future.result()
+            except Exception as exp:
+                rf = RequestedFile.from_failure(
+                    contents[index].get("url"),
+                    get_content_cache(contents[index], build_folder),
+                    exp,
+                    contents[index].get("checksum"),
+                )
+            results.append((contents[index], rf))
+            if on_complete is not None:
+                on_complete(contents[index], rf)
+
+            if not rf.successful:
+                # prevent pending downloads from starting
+                for pending in futures.keys():
+                    pending.cancel()
+                continue
+            report(index, contents[index]["archive_size"])
+
+    return results
+
+
+def unzip_file(
+    archive_fpath, src_fname, build_folder, dest_fpath=None, size=None, logger=None
+):
+    """ extracts an expected filename from a ZIP archive
+
+        file is streamed to dest_fpath (or into build_folder) as a sparse file
+        and expanded to `size` if specified (can't be smaller than file) """
+    if dest_fpath is None:
+        dest_fpath = os.path.join(build_folder, src_fname)
 
-def unzip_file(archive_fpath, src_fname, build_folder, dest_fpath=None):
-    """ extracts an expected filename from a ZIP archive """
     with zipfile.ZipFile(archive_fpath, "r") as zip_archive:
-        extraction = zip_archive.extract(src_fname, build_folder)
-        if dest_fpath:
-            shutil.move(extraction, dest_fpath)
+        file_size = zip_archive.getinfo(src_fname).file_size
+        if size is not None and size < file_size:
+            raise ValueError(
+                "cannot decrease image size ({s1} to {s2})".format(
+                    s1=human_readable_size(file_size), s2=human_readable_size(size)
+                )
+            )
 
+        reported = [None]  # last reported percentage
+
+        def on_progress(extracted):
+            percentage = int(extracted * 100 / file_size)
+            if not logger.on_tty and percentage != reported[0]:
+                reported[0] = percentage
+                logger.ascii_progressbar(extracted, file_size)
+
+        with zip_archive.open(src_fname, "r") as fileobj:
+            write_sparse(
+                fileobj,
+                dest_fpath,
+                size=size,
+                on_progress=on_progress
+                if logger is not None and not logger.on_tty
+                else None,
+            )
 
-def unzip_archive(archive_fpath, dest_folder):
-    """ extracts a ZIP archive (all files) """
-    with zipfile.ZipFile(archive_fpath) as zip_archive:
-        zip_archive.extractall(dest_folder)
 
+class ProgressReader:
+    """ binary file wrapper calling on_progress with the number of bytes read """
 
-def unarchive(archive_fpath, dest_folder, logger):
-    """ extracts a supported archive to a specified folder """
+    def __init__(self, fileobj, on_progress):
+        self.fileobj = fileobj
+        self.on_progress = on_progress
+        self.read_size = 0
 
-    supported_extensions = (".zip", ".tar", ".tar.bz2", ".tar.gz", ".tar.xz")
-    if sum([1 for ext in supported_extensions if archive_fpath.endswith(ext)]) == 0:
-        raise NotImplementedError(
-            "Archive format extraction not supported: {}".format(archive_fpath)
-        )
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.read_size += len(data)
+        self.on_progress(self.read_size)
+        return data
 
-    if archive_fpath.endswith(".zip"):
-        unzip_archive(archive_fpath, dest_folder)
-        return
 
-    if sys.platform == "win32":
-        # 7z does not natively support uncompressing tar.xx in one step
-        if re.match(r".*\.tar\.(bz2|gz|xz)$", archive_fpath):
-            win_unarchive_compressed_tar_pipe(archive_fpath, dest_folder, logger)
-            return
+def get_member_path(name, dest_folder, strip_folder=None):
+    """ destination path of an archive member (None if it should be skipped)
 
-        command = [szip_exe, "x", "-o{}".format(dest_folder), archive_fpath]
-    else:
-        tar_exe = "/usr/bin/tar" if sys.platform == "darwin" else "/bin/tar"
-        # using -o and -m as exfat dont support mod times and ownership is different
-        command = [tar_exe, "-C", dest_folder, "-x", "-m", "-o", "-f", archive_fpath]
+        strip_folder: only members within this folder are extracted,
+        directly into dest_folder """
+    parts = [
+        part for part in name.replace("\\", "/").split("/") if part not in ("", ".")
+    ]
+    if ".." in parts:
+        raise ValueError("Unsafe path in archive: {}".format(name))
+    if strip_folder:
+        strip_parts = [part for part in strip_folder.split("/") if part]
+        if parts[: len(strip_parts)] != strip_parts:
+            return None
+        parts = parts[len(strip_parts) :]
+    return os.path.join(dest_folder, *parts)
+
+
+def write_member(fileobj, dest_fpath, size):
+    """ stream an archive member into its destination using large writes
+
+        destinations within an ExFATWriter are written directly to its image """
+    exfat.makedirs(os.path.dirname(dest_fpath))
+    target = exfat.get_writer(dest_fpath)
+    if target is not None:
+        writer, relpath = target
+        with writer.open_file(relpath, size) as fh:
+            shutil.copyfileobj(fileobj, fh, EXTRACT_BUFFER_SIZE)
+        return
+    with open(dest_fpath, "wb", buffering=EXTRACT_BUFFER_SIZE) as fh:
+        shutil.copyfileobj(fileobj, fh, EXTRACT_BUFFER_SIZE)
 
-    subprocess_pretty_check_call(command, logger)
 
+def unarchive(archive_fpath, dest_folder, logger, strip_folder=None):
+    """ extracts a supported archive to a specified folder
 
-def win_unarchive_compressed_tar_pipe(archive_fpath, dest_folder, logger):
-    """ uncompress tar.[bz2|gz] on windows in a single pass """
+        archive is read as a stream and entries written directly to their
+        final location (no temporary folder).
+        strip_folder: only extract this folder's content (into dest_folder)
 
-    # 7z extraction to stdout
-    uncompress = subprocess.Popen(
-        [szip_exe, "x", "-so", archive_fpath],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        **startup_info_args()
-    )
-    logger.std("Call: " + str(uncompress.args))
-
-    # 7x tar extraction using stdin (piping other process' stdout)
-    untar = subprocess.Popen(
-        [szip_exe, "x", "-si", "-ttar", "-o{}".format(dest_folder)],
-        stdin=uncompress.stdout,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        **startup_info_args()
-    )
-    logger.std("Call: " + str(untar.args))
+        compressed tar are decompressed using a parallel decompressor if
+        available (see get_decompressor). returns the engine used """
 
-    uncompress.wait()
-    untar.wait()
-
-    for line in untar.stdout.readlines():
-        logger.raw_std(line.decode("utf-8", "ignore"))
-
-    assert untar.returncode == 0
+    supported_extensions = (".zip", ".tar", ".tar.bz2", ".tar.gz", ".tar.xz")
+    if sum([1 for ext in supported_extensions if archive_fpath.endswith(ext)]) == 0:
+        raise NotImplementedError(
+            "Archive format extraction not supported: {}".format(archive_fpath)
+        )
 
+    archive_size = os.path.getsize(archive_fpath)
+    reported = [None]  # last reported percentage
 
-def win_unarchive_compressed_tar(archive_fpath, dest_folder, logger):
-    """ uncompress tar.[bz2|gz] on windows using two passes """
+    def on_progress(processed):
+        percentage = int(processed * 100 / (archive_size or 1))
+        if not logger.on_tty and percentage != reported[0]:
+            reported[0] = percentage
+            logger.ascii_progressbar(processed, archive_size)
 
-    # uncompress first
-    subprocess_pretty_check_call(
-        [szip_exe, "x", "-o{}".format(dest_folder), archive_fpath], logger
-    )
+    exfat.makedirs(dest_folder)
 
-    # retrieve extracted tar fpath
-    tar_fname = [fname for fname in os.listdir(dest_folder) if fname.endswith(".tar")][
-        -1
-    ]
-    tar_fpath = os.path.join(dest_folder, tar_fname)
+    if archive_fpath.endswith(".zip"):
+        with zipfile.ZipFile(archive_fpath) as zip_archive:
+            processed = 0
+            for member in zip_archive.infolist():
+                dest_path = get_member_path(member.filename, dest_folder, strip_folder)
+                if dest_path is not None:
+                    if member.is_dir():
+                        exfat.makedirs(dest_path)
+                    else:
+                        with zip_archive.open(member) as fileobj:
+                            write_member(fileobj, dest_path, member.file_size)
+                processed += member.compress_size
+                on_progress(processed)
+        return "zipfile"
+
+    engine, command = get_decompressor(archive_fpath)
+    logger.std("Decompressing {} using {}".format(archive_fpath, engine))
+
+    if command is not None:
+        # external parallel decompressor, fed from here to report progress
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            **startup_info_args()
+        )
 
-    # untar
-    subprocess_pretty_check_call(
-        [szip_exe, "x", "-ttar", "-o{}".format(dest_folder), tar_fpath], logger
-    )
-    # remove tar
-    os.remove(tar_fpath)
+        def feed():
+            try:
+                with open(archive_fpath, "rb") as fh:
+                    shutil.copyfileobj(
+                        ProgressReader(fh, on_progress),
+                        process.stdin,
+                        EXTRACT_BUFFER_SIZE,
+                    )
+            except BrokenPipeError:
+                pass  # decompressor failed (see return code)
+            finally:
+                process.stdin.close()
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            extract_tar(process.stdout, dest_folder, logger, strip_folder)
+        finally:
+            process.stdout.close()
+            feeder.join()
+            process.wait()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        return engine
+
+    with open(archive_fpath, "rb") as fh:
+        reader = ProgressReader(fh, on_progress)
+        if engine == PYTHON_PARALLEL_BZ2:
+            reader = ParallelBZ2Reader(reader, workers=os.cpu_count() or 1)
+        try:
+            extract_tar(reader, dest_folder, logger, strip_folder)
+        finally:
+            if engine == PYTHON_PARALLEL_BZ2:
+                reader.close()
+    return engine
+
+
+def get_decompressor(archive_fpath):
+    """ (engine name, command) of best decompressor for a tar archive
+
+        command (decompressing stdin to stdout) is None for python engines """
+    if archive_fpath.endswith(".tar.bz2"):
+        if shutil.which("lbzip2"):
+            return "lbzip2", [shutil.which("lbzip2"), "-d", "-c"]
+        if shutil.which("pbzip2"):
+            return "pbzip2", [shutil.which("pbzip2"), "-d", "-c"]
+        return PYTHON_PARALLEL_BZ2, None
+    if archive_fpath.endswith(".tar.gz") and shutil.which("pigz"):
+        return "pigz", [shutil.which("pigz"), "-d", "-c"]
+    if archive_fpath.endswith(".tar.xz") and shutil.which("xz"):
+        # multi-threaded decompression requires xz 5.4+ (ignored otherwise)
+        return "xz", [shutil.which("xz"), "-d", "-c", "-T0"]
+    return "python", None
+
+
+def extract_tar(fileobj, dest_folder, logger, strip_folder=None):
+    """ extract a tar stream (decompressed or not) into dest_folder """
+    # stream mode: members are read in order, archive is never seeked
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar_archive:
+        for member in tar_archive:
+            dest_path = get_member_path(member.name, dest_folder, strip_folder)
+            if dest_path is None:
+                continue
+            if member.isdir():
+                exfat.makedirs(dest_path)
+            elif member.isfile():
+                write_member(tar_archive.extractfile(member), dest_path, member.size)
+            else:
+                # exFAT has no links nor special files
+                logger.std("Skipping non-regular file: {}".format(member.name))
@@ -0,0 +1,547 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" userspace exFAT writer for the image's data partition
+
+    lays out an exFAT filesystem directly inside the image file (at the data
+    partition's offset) without formatting nor mounting it: no loop device,
+    no FUSE and no root privileges.
+
+    files are allocated contiguously (NoFatChain) in the order they are added
+    and their data is written right away. directories (FAT-chained),
+    allocation bitmap, FAT and boot regions are written on close() once the
+    tree is complete.
+
+    ExFATWriter.root is a virtual path: makedirs(), open_file() and
+    copy_file() route paths within it to the writer. """
+
+import os
+import math
+import struct
+import random
+import datetime
+import threading
+import collections
+
+from util import EXFAT_FORBIDDEN_CHARS
+
+SECTOR_SIZE = 512
+SECTOR_SHIFT = 9
+FAT_OFFSET = 2048  # sectors (1MiB) from start of volume
+ENTRY_SIZE = 32
+NAME_CHARS_PER_ENTRY = 15
+
+ENTRY_BITMAP = 0x81
+ENTRY_UPCASE = 0x82
+ENTRY_LABEL = 0x83
+ENTRY_FILE = 0x85
+ENTRY_STREAM = 0xC0
+ENTRY_NAME = 0xC1
+
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+
+FLAG_ALLOCATION_POSSIBLE = 0x01
+FLAG_NO_FAT_CHAIN = 0x02
+
+FAT_END_OF_CHAIN = 0xFFFFFFFF
+FAT_MEDIA = 0xFFFFFFF8
+
+WRITERS = {}  # root: ExFATWriter, for routing of virtual paths
+
+
+def get_cluster_size(volume_size):
+    """ default cluster size for a volume (same as mkfs.exfat) """
+    if volume_size <= 256 * 2 ** 20:
+        return 4096
+    if volume_size <= 32 * 2 ** 30:
+        return 32768
+    return 131072
+
+
+def upcase(char):
+    """ up-case code point of a BMP code point """
+    upper = chr(char).upper()
+    if len(upper) != 1 or ord(upper) > 0xFFFF:
+        return char
+    return ord(upper)
+
+
+def get_upcase_table():
+    """ compressed up-case table (identity runs are 0xFFFF, length) """
+    entries = []
+    char = 0
+    while char <= 0xFFFF:
+        run = 0
+        while char + run <= 0xFFFF and upcase(char + run) == char + run:
+            run += 1
+        if run > 2:
+            entries += [0xFFFF, run]
+            char += run
+        else:
+            entries.append(upcase(char))
+            char += 1
+    return struct.pack("<{}H".format(len(entries)), *entries)
+
+
+def get_table_checksum(data):
+    checksum = 0
+    for byte in data:
+        checksum = (((checksum << 31) | (checksum >> 1)) + byte) & 0xFFFFFFFF
+    return checksum
+
+
+def get_boot_checksum(data):
+    """ checksum of the 11 first sectors (excluding volatile fields) """
+    checksum = 0
+    for index, byte in enumerate(data):
+        if index in (106, 107, 112):  # VolumeFlags and PercentInUse
+            continue
+        checksum = (((checksum << 31) | (checksum >> 1)) + byte) & 0xFFFFFFFF
+    return checksum
+
+
+def get_set_checksum(data):
+    """ checksum of a directory entry set """
+    checksum = 0
+    for index, byte in enumerate(data):
+        if index in (2, 3):  # SetChecksum field
+            continue
+        checksum = (((checksum << 15) | (checksum >> 1)) + byte) & 0xFFFF
+    return checksum
+
+
+def get_name_units(name):
+    """ UTF-16 code units of a name (exFAT names' characters) """
+    encoded = name.encode("utf-16-le", "surrogatepass")
+    return struct.unpack("<{}H".format(len(encoded) // 2), encoded)
+
+
+def upcase_name(name):
+    """ name up-cased using the volume's up-case table """
+    return "".join([chr(upcase(unit)) for unit in get_name_units(name)])
+
+
+def get_name_hash(name):
+    """ hash of the up-cased name (speeds up lookups) """
+    checksum = 0
+    for unit in get_name_units(name):
+        for byte in (upcase(unit) & 0xFF, upcase(unit) >> 8):
+            checksum = (((checksum << 15) | (checksum >> 1)) + byte) & 0xFFFF
+    return checksum
+
+
+def get_timestamp(date):
+    """ exFAT (DOS-like) timestamp for a datetime """
+    return (
+        (date.year - 1980) << 25
+        | date.month << 21
+        | date.day << 16
+        | date.hour << 11
+        | date.minute << 5
+        | date.second // 2
+    )
+
+
+def split_path(path):
+    return [part for part in path.replace("\\", "/").split("/") if part and part != "."]
+
+
+def get_writer(path):
+    """ (writer, relative path) for a virtual path (None if not one) """
+    for root, writer in WRITERS.items():
+        if (
+            path == root
+            or path.startswith(root + os.sep)
+            or path.startswith(root + "/")
+        ):
+            return writer, path[len(root) :]
+    return None
+
+
+def makedirs(path):
+    """ os.makedirs(exist_ok=True) aware of ExFATWriter virtual paths """
+    target = get_writer(path)
+    if target is None:
+        os.makedirs(path, exist_ok=True)
+    else:
+        writer, relpath = target
+        writer.makedirs(relpath)
+
+
+class ExFATFile:
+    """ write-only file object to a contiguous extent of the image """
+
+    def __init__(self, writer, offset, size):
+        self.writer = writer
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def write(self, data):
+        if self.position + len(data) > self.size:
+            raise IOError("writing past end of reserved file size")
+        self.writer.pwrite(data, self.offset + self.position)
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if self.position != self.size:
+            raise IOError(
+                "file incomplete ({}/{} bytes)".format(self.position, self.size)
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class ExFATWriter:
+    def __init__(self, image_fpath, offset, size, label, logger):
+        self.image_fpath = image_fpath
+        self.offset = offset  # bytes offset of volume in image
+        self.logger = logger
+        self.label = label[:11]
+        self.lock = threading.Lock()
+        self.date = datetime.datetime.now()
+        self.root = os.path.join(
+            os.path.abspath(os.sep), "exfat-{}".format(random.randint(0, 2 ** 32))
+        )
+
+        # volume geometry
+        self.cluster_size = get_cluster_size(size)
+        self.sectors_per_cluster = self.cluster_size // SECTOR_SIZE
+        self.volume_length = size // SECTOR_SIZE
+        self.cluster_count = (
+            self.volume_length - FAT_OFFSET
+        ) // self.sectors_per_cluster
+        while True:  # FAT size depends on cluster count which depends on it
+            self.fat_length = math.ceil((self.cluster_count + 2) * 4 / SECTOR_SIZE)
+            self.heap_offset = (
+                math.ceil((FAT_OFFSET + self.fat_length) / self.sectors_per_cluster)
+                * self.sectors_per_cluster
+            )
+            cluster_count = (
+                self.volume_length - self.heap_offset
+            ) // self.sectors_per_cluster
+            if cluster_count == self.cluster_count:
+                break
+            self.cluster_count = cluster_count
+
+        self.next_cluster = 2  # first cluster of heap
+        self.chains = []  # (first cluster, nb clusters) needing a FAT chain
+
+        # root directory tree
+        self.tree = self.new_node("", True)
+
+        self.fd = os.open(image_fpath, os.O_RDWR | getattr(os, "O_BINARY", 0))
+
+        # allocation bitmap and up-case table come first in the heap
+        self.bitmap_size = math.ceil(self.cluster_count / 8)
+        self.bitmap_cluster = self.allocate(self.bitmap_size, chain=True)
+        self.upcase_table = get_upcase_table()
+        self.upcase_cluster = self.allocate(len(self.upcase_table), chain=True)
+        self.pwrite(self.upcase_table, self.get_cluster_offset(self.upcase_cluster))
+
+        WRITERS[self.root] = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.release()
+
+    def new_node(self, name, is_dir):
+        return {
+            "name": name,
+            "is_dir": is_dir,
+            "children": collections.OrderedDict() if is_dir else None,
+            "first_cluster": 0,
+            "size": 0,
+        }
+
+    def get_cluster_offset(self, cluster):
+        """ bytes offset in image of a cluster """
+        return (
+            self.offset
+            + self.heap_offset * SECTOR_SIZE
+            + (cluster - 2) * self.cluster_size
+        )
+
+    def pwrite(self, data, offset):
+        if hasattr(os, "pwrite"):
+            while data:
+                written = os.pwrite(self.fd, data, offset)
+                data, offset = data[written:], offset + written
+        else:
+            with self.lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                os.write(self.fd, data)
+
+    def allocate(self, size, chain=False):
+        """ first cluster of a new contiguous allocation for size bytes """
+        nb_clusters = max([1, math.ceil(size / self.cluster_size)])
+        with self.lock:
+            if self.next_cluster + nb_clusters > self.cluster_count + 2:
+                raise IOError("No space left on data partition")
+            first_cluster = self.next_cluster
+            self.next_cluster += nb_clusters
+            if chain:
+                self.chains.append((first_cluster, nb_clusters))
+        return first_cluster
+
+    def get_node(self, relpath, create_parents=True):
+        """ (parent node, name) for a relative path """
+        parts = split_path(relpath)
+        if not parts:
+            raise ValueError("Invalid path: {}".format(relpath))
+        # no kernel driver to reject names exFAT can't hold
+        for part in parts:
+            if part == ".." or any(
+                char in EXFAT_FORBIDDEN_CHARS or ord(char) < 0x20 for char in part
+            ):
+                raise ValueError("Invalid exFAT name `{}` in {}".format(part, relpath))
+        node = self.tree
+        with self.lock:
+            for part in parts[:-1]:
+                key = upcase_name(part)
+                if key not in node["children"]:
+                    if not create_parents:
+                        raise FileNotFoundError(relpath)
+                    node["children"][key] = self.new_node(part, True)
+                node = node["children"][key]
+                if not node["is_dir"]:
+                    raise NotADirectoryError(relpath)
+        return node, parts[-1]
+
+    def makedirs(self, relpath):
+        if not split_path(relpath):
+            return
+        parent, name = self.get_node(relpath)
+        with self.lock:
+            key = upcase_name(name)
+            if key not in parent["children"]:
+                parent["children"][key] = self.new_node(name, True)
+            elif not parent["children"][key]["is_dir"]:
+                raise FileExistsError(relpath)
+
+    def add_file(self, relpath, size):
+        """ allocate a new file and return its bytes offset in image """
+        parent, name = self.get_node(relpath)
+        node = self.new_node(name, False)
+        node["size"] = size
+        if size:
+            node["first_cluster"] = self.allocate(size)
+        with self.lock:
+            # replaced files keep their clusters allocated (wasted)
+            parent["children"][upcase_name(name)] = node
+        return self.get_cluster_offset(node["first_cluster"])
+
+    def open_file(self, relpath, size):
+        """ write-only file object for a new file of exactly size bytes """
+        return ExFATFile(self, self.add_file(relpath, size), size)
+
+    def copy_file(self, src_fpath, relpath):
+        """ copy a host file into the volume (in-kernel if possible)
+
+            returns the copy engine used """
+        size = os.path.getsize(src_fpath)
+        offset = self.add_file(relpath, size)
+        copied = 0
+        engine = "copy_file_range"
+        with open(src_fpath, "rb") as src:
+            if hasattr(os, "copy_file_range"):
+                try:
+                    while copied < size:
+                        chunk = os.copy_file_range(
+                            src.fileno(),
+                            self.fd,
+                            min([size - copied, 2 ** 30]),
+                            copied,
+                            offset + copied,
+                        )
+                        if not chunk:
+                            break
+                        copied += chunk
+                except OSError:
+                    pass  # not supported between those files: copy in userspace
+            src.seek(copied)
+            if copied < size:
+                engine = "buffer"
+            while copied < size:
+                data = src.read(16 * 2 ** 20)
+                if not data:
+                    break
+                self.pwrite(data, offset + copied)
+                copied += len(data)
+        if copied != size:
+            raise IOError("{} was not fully copied".format(src_fpath))
+        return engine
+
+    def get_entry_set(self, node):
+        """ directory entries (file, stream, names) for a node """
+        name = node["name"].encode("utf-16-le", "surrogatepass")
+        name_length = len(name) // 2
+        if name_length > 255:
+            raise ValueError("Name too long: {}".format(node["name"]))
+        nb_name_entries = math.ceil(name_length / NAME_CHARS_PER_ENTRY)
+        timestamp = get_timestamp(self.date)
+
+        file_entry = struct.pack(
+            "<BBHHHIIIBBBBB7x",
+            ENTRY_FILE,
+            1 + nb_name_entries,
+            0,  # SetChecksum (computed below)
+            ATTR_DIRECTORY if node["is_dir"] else ATTR_ARCHIVE,
+            0,
+            timestamp,
+            timestamp,
+            timestamp,
+            0,
+            0,
+            0,
+            0,
+            0,
+        )
+
+        flags = FLAG_ALLOCATION_POSSIBLE
+        if node["first_cluster"] and not node["is_dir"]:
+            flags |= FLAG_NO_FAT_CHAIN
+        stream_entry = struct.pack(
+            "<BBBBHHQIIQ",
+            ENTRY_STREAM,
+            flags,
+            0,
+            name_length,
+            get_name_hash(node["name"]),
+            0,
+            node["size"],  # ValidDataLength
+            0,
+            node["first_cluster"],
+            node["size"],  # DataLength
+        )
+
+        name_entries = b""
+        for index in range(nb_name_entries):
+            part = name[index * 30 : (index + 1) * 30]
+            name_entries += struct.pack("<BB", ENTRY_NAME, 0) + part.ljust(30, b"\0")
+
+        entry_set = bytearray(file_entry + stream_entry + name_entries)
+        struct.pack_into("<H", entry_set, 2, get_set_checksum(entry_set))
+        return bytes(entry_set)
+
+    def get_root_entries(self):
+        """ volume label, bitmap and up-case table entries of root directory """
+        label = self.label.encode("utf-16-le")
+        return (
+            struct.pack("<BB", ENTRY_LABEL, len(self.label))
+            + label.ljust(22, b"\0")
+            + bytes(8)
+            + struct.pack(
+                "<BB18xIQ", ENTRY_BITMAP, 0, self.bitmap_cluster, self.bitmap_size,
+            )
+            + struct.pack(
+                "<B3xI12xIQ",
+                ENTRY_UPCASE,
+                get_table_checksum(self.upcase_table),
+                self.upcase_cluster,
+                len(self.upcase_table),
+            )
+        )
+
+    def write_directory(self, node, is_root=False):
+        """ allocate and write a directory (children first) """
+        entries = self.get_root_entries() if is_root else b""
+        for child in node["children"].values():
+            if child["is_dir"]:
+                self.write_directory(child)
+            entries += self.get_entry_set(child)
+
+        size = max([1, math.ceil(len(entries) / self.cluster_size)]) * self.cluster_size
+        node["first_cluster"] = self.allocate(size, chain=True)
+        node["size"] = size
+        self.pwrite(
+            entries.ljust(size, b"\0"), self.get_cluster_offset(node["first_cluster"])
+        )
+
+    def write_fat(self):
+        fat = bytearray(self.fat_length * SECTOR_SIZE)
+        struct.pack_into("<II", fat, 0, FAT_MEDIA, FAT_END_OF_CHAIN)
+        for first_cluster, nb_clusters in self.chains:
+            for cluster in range(first_cluster, first_cluster + nb_clusters - 1):
+                struct.pack_into("<I", fat, cluster * 4, cluster + 1)
+            struct.pack_into(
+                "<I", fat, (first_cluster + nb_clusters - 1) * 4, FAT_END_OF_CHAIN
+            )
+        self.pwrite(bytes(fat), self.offset + FAT_OFFSET * SECTOR_SIZE)
+
+    def write_bitmap(self):
+        # clusters are allocated contiguously from the start of the heap
+        used = self.next_cluster - 2
+        bitmap = bytearray(
+            math.ceil(self.bitmap_size / self.cluster_size) * self.cluster_size
+        )
+        bitmap[: used // 8] = b"\xff" * (used // 8)
+        if used % 8:
+            bitmap[used // 8] = (1 << (used % 8)) - 1
+        self.pwrite(bytes(bitmap), self.get_cluster_offset(self.bitmap_cluster))
+
+    def write_boot_region(self):
+        used = self.next_cluster - 2
+        boot_sector = bytearray(SECTOR_SIZE)
+        boot_sector[0:3] = b"\xeb\x76\x90"
+        boot_sector[3:11] = b"EXFAT   "
+        struct.pack_into(
+            "<QQIIIIIIHHBBBBB",
+            boot_sector,
+            64,
+            self.offset // SECTOR_SIZE,  # PartitionOffset
+            self.volume_length,
+            FAT_OFFSET,
+            self.fat_length,
+            self.heap_offset,
+            self.cluster_count,
+            self.tree["first_cluster"],
+            random.randint(0, 2 ** 32 - 1),  # VolumeSerialNumber
+            0x0100,  # FileSystemRevision
+            0,  # VolumeFlags
+            SECTOR_SHIFT,
+            int(math.log2(self.sectors_per_cluster)),
+            1,  # NumberOfFats
+            0x80,  # DriveSelect
+            min([100, used * 100 // self.cluster_count]),
+        )
+        boot_sector[510:512] = b"\x55\xaa"
+
+        extended_sector = bytearray(SECTOR_SIZE)
+        extended_sector[508:512] = b"\x00\x00\x55\xaa"
+
+        region = (
+            bytes(boot_sector)
+            + bytes(extended_sector) * 8
+            + bytes(SECTOR_SIZE) * 2  # OEM parameters and reserved
+        )
+        region += struct.pack("<I", get_boot_checksum(region)) * (SECTOR_SIZE // 4)
+
+        # main and backup boot regions
+        self.pwrite(region * 2, self.offset)
+
+    def close(self):
+        """ write directories and filesystem structures """
+        self.logger.std("Writing exFAT filesystem structures")
+        self.write_directory(self.tree, is_root=True)
+        self.write_fat()
+        self.write_bitmap()
+        self.write_boot_region()
+        os.fsync(self.fd)
+        self.release()
+
+    def release(self):
+        WRITERS.pop(self.root, None)
+        os.close(self.fd)
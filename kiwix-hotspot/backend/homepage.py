@@ -4,16 +4,16 @@
 import os
 import tempfile
 
-import yaml
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 from data import data_dir
+from util import yaml_load
 from backend.catalog import get_package
 
 
 def get_ansible_group_vars():
     with open(os.path.join(data_dir, "ansiblecube", "group_vars", "all"), "r") as fp:
-        return yaml.load(fp.read())
+        return yaml_load(fp)
 
 
 ANSIBLE_GROUP_VARS = get_ansible_group_vars()
@@ -4,7 +4,6 @@
 import os
 import re
 import sys
-import time
 import string
 import random
 import tempfile
@@ -17,6 +16,8 @@ from backend.util import (
     subprocess_pretty_check_call,
     subprocess_pretty_call,
     subprocess_external,
+    wait_for,
+    RELEASE_TIMEOUT,
 )
 
 
@@ -74,6 +75,13 @@ def get_start_offset(root_size, disk_size):
     return data_start * sector_size, data_bytes
 
 
+def get_data_partition_extent(image_fpath, logger):
+    """ bytes offset and bytes size of the data partition within image """
+    base_image = get_content("hotspot_master_image")
+    disk_size = get_qemu_image_size(image_fpath, logger)
+    return get_start_offset(base_image.get("root_partition_size"), disk_size)
+
+
 def get_partition_size(image_fpath, start_bytes, logger):
     """ bytes size of the data partition """
     full_size = get_qemu_image_size(image_fpath, logger)
@@ -192,6 +200,22 @@ def restore_mode(fpath, mode, logger):
     )
 
 
+def unmount_device_partitions(device, logger):
+    """ unmount all mounted partitions of a device (linux) """
+    with open("/proc/mounts", "r") as fh:
+        sources = [line.split()[0] for line in fh.readlines() if line.strip()]
+    for source in sources:
+        if not re.match(r"^{}p?\d+$".format(re.escape(device)), source):
+            continue
+        if bool(os.getenv("NO_UDISKS", False)):
+            subprocess_pretty_check_call([umount_exe, source], logger)
+        else:
+            subprocess_pretty_check_call(
+                [udisksctl_exe, "unmount", "--block-device", source, udisks_nou],
+                logger,
+            )
+
+
 def guess_next_loop_device(logger):
     def _no_udisks(logger):
         """ guess loop device w/o udisks (using losetup/root) """
@@ -297,11 +321,7 @@ def get_virtual_device(image_fpath, logger):
 
     if sys.platform == "linux":
         # find out offset for third partition from the root part size
-        base_image = get_content("hotspot_master_image")
-        disk_size = get_qemu_image_size(image_fpath, logger)
-        offset, size = get_start_offset(
-            base_image.get("root_partition_size"), disk_size
-        )
+        offset, size = get_data_partition_extent(image_fpath, logger)
 
         # prepare loop device
         if bool(os.getenv("NO_UDISKS", False)):
@@ -528,23 +548,40 @@ def mount_data_partition(image_fpath, logger):
         return mount_point, target_dev
 
 
-def unmount_data_partition(mount_point, device, logger):
-    """ unmount data partition and free virtual resources """
+def is_loop_attached(device):
+    """ whether a linux loop device is still backed by a file """
+    return os.path.exists(
+        "/sys/block/{}/loop/backing_file".format(os.path.basename(device))
+    )
 
-    if sys.platform == "linux":
 
-        # sleep to prevent unmount failures
-        time.sleep(5)
+def unmount_data_partition(mount_point, device, logger, timeout=RELEASE_TIMEOUT):
+    """ unmount data partition and free virtual resources
+
+        linux: unmount is retried while the partition is busy (timeout) """
+
+    if sys.platform == "linux":
 
         if mount_point:
-            # unmount using device path
+            # flush writes then unmount using device path
+            if hasattr(os, "sync"):
+                os.sync()
             if bool(os.getenv("NO_UDISKS", False)):
-                subprocess_pretty_call([umount_exe, device], logger)
+                command = [umount_exe, device]
             else:
-                subprocess_pretty_call(
-                    [udisksctl_exe, "unmount", "--block-device", device, udisks_nou],
-                    logger,
-                )
+                command = [
+                    udisksctl_exe,
+                    "unmount",
+                    "--block-device",
+                    device,
+                    udisks_nou,
+                ]
+            if not wait_for(
+                lambda: subprocess_pretty_call(command, logger)[0] == 0,
+                timeout=timeout,
+                interval=1,
+            ):
+                logger.err("Unable to unmount {} (busy?)".format(device))
             try:
                 os.rmdir(mount_point)
             except (FileNotFoundError, PermissionError):
@@ -552,6 +589,8 @@ def unmount_data_partition(mount_point, device, logger):
 
         # delete the loop device (might have already been deleted)
         release_virtual_device(device, logger)
+        if not wait_for(lambda: not is_loop_attached(device), timeout=timeout):
+            logger.err("Loop device {} is still attached".format(device))
 
     elif sys.platform == "darwin":
 
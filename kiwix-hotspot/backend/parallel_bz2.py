@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" block-parallel bzip2 decompression (fallback for lbzip2/pbzip2)
+
+    bzip2 compresses data in independent blocks (up to 900kB each) which
+    start with a 48-bits magic number at any bit offset (not byte-aligned).
+    each block is wrapped into a standalone single-block bzip2 stream
+    (header, block, end-of-stream marker and CRC) and decompressed on a
+    thread pool: the bz2 module releases the GIL while decompressing. """
+
+import bz2
+import collections
+import concurrent.futures
+
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+STREAM_HEADER = 0x425A6839  # `BZh9`: largest block size, fits all blocks
+READ_SIZE = 8 * 2 ** 20
+
+
+def get_magic_patterns(magic):
+    """ (shift, head_mask, head, middle, tail_mask, tail) for each bit shift
+
+        the 48-bits magic starting at bit `shift` of a byte spans 7 bytes:
+        a partial first byte, 5 full middle bytes and a partial last byte.
+        when byte-aligned (shift 0), it is 6 full bytes """
+    patterns = []
+    for shift in range(8):
+        window = (magic << (8 - shift)).to_bytes(7, "big")
+        if shift == 0:
+            patterns.append((0, 0, 0, window[:6], 0, 0))
+        else:
+            head_mask = 0xFF >> shift
+            tail_mask = (0xFF << (8 - shift)) & 0xFF
+            patterns.append(
+                (shift, head_mask, window[0], window[1:6], tail_mask, window[6])
+            )
+    return patterns
+
+
+BLOCK_PATTERNS = get_magic_patterns(BLOCK_MAGIC)
+EOS_PATTERNS = get_magic_patterns(EOS_MAGIC)
+
+
+def find_magic(data, patterns):
+    """ bit offsets of the magic (from its patterns) in data """
+    offsets = []
+    for shift, head_mask, head, middle, tail_mask, tail in patterns:
+        # offset of middle part within the window
+        middle_offset = 0 if shift == 0 else 1
+        index = data.find(middle, middle_offset)
+        while index != -1:
+            byte_index = index - middle_offset
+            if shift == 0:
+                offsets.append(byte_index * 8)
+            elif (
+                byte_index + 6 < len(data)
+                and data[byte_index] & head_mask == head
+                and data[byte_index + 6] & tail_mask == tail
+            ):
+                offsets.append(byte_index * 8 + shift)
+            index = data.find(middle, index + 1)
+    return offsets
+
+
+def get_bits(data, start_bit, end_bit):
+    """ integer value of the bits between those offsets in data """
+    chunk = data[start_bit // 8 : (end_bit + 7) // 8]
+    length = end_bit - start_bit
+    value = int.from_bytes(chunk, "big")
+    value >>= len(chunk) * 8 - start_bit % 8 - length
+    return value & ((1 << length) - 1)
+
+
+def get_block_stream(value, length):
+    """ standalone bzip2 stream for a block's bits """
+    # block CRC follows the block magic. single-block stream: same CRC
+    crc = (value >> (length - 80)) & 0xFFFFFFFF
+
+    stream = (((STREAM_HEADER << length) | value) << 48 | EOS_MAGIC) << 32 | crc
+    nb_bits = 32 + length + 48 + 32
+    padding = -nb_bits % 8
+    return (stream << padding).to_bytes((nb_bits + padding) // 8, "big")
+
+
+def decompress_block(value, length):
+    """ decompressed data of a block
+
+        raises EOFError if the bits are not exactly a complete block, which
+        happens when a block was split on a false-positive magic number """
+    decompressor = bz2.BZ2Decompressor()
+    data = decompressor.decompress(get_block_stream(value, length))
+    if not decompressor.eof or decompressor.unused_data:
+        raise EOFError("incomplete bzip2 block")
+    return data
+
+
+def iter_segments(fileobj):
+    """ yields (value, length, is_block) for consecutive segments of fileobj
+
+        segments are delimited by block and end-of-stream magics. only
+        segments starting with a block magic (is_block) are blocks ; others
+        are end-of-stream markers, CRC and headers of concatenated streams """
+    data = b""
+    while True:
+        new_data = fileobj.read(READ_SIZE)
+        data += new_data
+
+        boundaries = sorted(
+            [(offset, True) for offset in find_magic(data, BLOCK_PATTERNS)]
+            + [(offset, False) for offset in find_magic(data, EOS_PATTERNS)]
+        )
+
+        last = None
+        for (offset, is_block), (next_offset, _) in zip(boundaries, boundaries[1:]):
+            yield get_bits(data, offset, next_offset), next_offset - offset, is_block
+            last = next_offset
+
+        if not new_data:
+            if boundaries and boundaries[-1][1]:
+                raise IOError("bzip2 data is truncated")
+            return
+
+        # keep data from last boundary (found again on next pass)
+        if last is not None:
+            data = data[last // 8 :]
+
+
+class ParallelBZ2Reader:
+    """ read-only file object of decompressed bzip2 data from fileobj """
+
+    def __init__(self, fileobj, workers):
+        self.workers = workers
+        self.segments = iter_segments(fileobj)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.pending = collections.deque()  # (value, length, future) in order
+        self.buffer = b""  # last decompressed block
+        self.offset = 0  # position in buffer
+
+    def fill(self):
+        """ keep enough blocks being decompressed to use all workers """
+        while len(self.pending) < self.workers * 2:
+            try:
+                value, length, is_block = next(self.segments)
+            except StopIteration:
+                break
+            future = (
+                self.executor.submit(decompress_block, value, length)
+                if is_block
+                else None
+            )
+            self.pending.append((value, length, future))
+
+    def next_block(self):
+        """ decompressed data of next block (None at end of file) """
+        while True:
+            self.fill()
+            if not self.pending:
+                return None
+            value, length, future = self.pending.popleft()
+            if future is not None:
+                break
+
+        try:
+            return future.result()
+        except (OSError, EOFError, ValueError):
+            pass
+
+        # magic number (block or end-of-stream) found inside compressed data
+        # (false positive): merge with following segments until it decompresses
+        while True:
+            self.fill()
+            if not self.pending:
+                raise IOError("invalid bzip2 data")
+            next_value, next_length, _ = self.pending.popleft()
+            value, length = (value << next_length) | next_value, length + next_length
+            try:
+                return decompress_block(value, length)
+            except (OSError, EOFError, ValueError):
+                continue
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self.offset >= len(self.buffer):
+                block = self.next_block()
+                if block is None:  # input is exhausted
+                    break
+                self.buffer, self.offset = block, 0
+                continue
+            end = len(self.buffer) if size < 0 else self.offset + size
+            chunk = self.buffer[self.offset : end]
+            self.offset += len(chunk)
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
+    def close(self):
+        for _, _, future in self.pending:
+            if future is not None:
+                future.cancel()
+        self.executor.shutdown(wait=True)
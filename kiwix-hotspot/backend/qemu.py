@@ -1,26 +1,30 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
+import io
 import os
 import re
 import sys
 import time
+import queue
 import socket
 import psutil
 import random
+import tarfile
 import posixpath
+import selectors
 import threading
 import subprocess
-import collections
 import multiprocessing
 
 import paramiko
 
 from .util import startup_info_args
 from .util import subprocess_pretty_check_call
-from util import ONE_GiB, ONE_MiB, human_readable_size
+from util import ONE_GiB, ONE_MiB, human_readable_size, get_folder_checksum
 
 timeout = 10 * 60
+PUT_DIR_MARKER_FNAME = ".put_dir_checksum"
 
 if os.name == "nt":
     qemu_system_arm_exe = "qemu\qemu-system-arm.exe"
@@ -61,9 +65,9 @@ def get_free_port():
     return port
 
 
-def get_qemu_image_size(image_fpath, logger):
+def get_qemu_image_size(image_fpath, logger, image_format="raw"):
     output = subprocess_pretty_check_call(
-        [qemu_img_exe_path, "info", "-f", "raw", image_fpath], logger
+        [qemu_img_exe_path, "info", "-f", image_format, image_fpath], logger
     )
     matches = []
     for line_number, line in enumerate(output):
@@ -75,8 +79,49 @@ def get_qemu_image_size(image_fpath, logger):
     return int(matches[0])
 
 
+def create_overlay(backing_fpath, overlay_fpath, size, logger):
+    """ create a qcow2 image of `size` on top of a (read-only) raw image
+
+        all writes go to the overlay, leaving the backing file untouched """
+    subprocess_pretty_check_call(
+        [
+            qemu_img_exe_path,
+            "create",
+            "-f",
+            "qcow2",
+            "-b",
+            os.path.abspath(backing_fpath),
+            "-F",
+            "raw",
+            overlay_fpath,
+            str(size),
+        ],
+        logger,
+    )
+
+
+def flatten_image(overlay_fpath, image_fpath, logger):
+    """ write a qcow2 overlay and its backing file into a single raw image
+
+        zeroed areas are not written (target image is sparse) """
+    subprocess_pretty_check_call(
+        [
+            qemu_img_exe_path,
+            "convert",
+            "-f",
+            "qcow2",
+            "-O",
+            "raw",
+            overlay_fpath,
+            image_fpath,
+        ],
+        logger,
+    )
+
+
 class Emulator:
     _image = None
+    _image_format = "raw"
     _kernel = None
     _dtb = None
     _logger = None
@@ -86,10 +131,13 @@ class Emulator:
     # password=raspberry
     # prompt end by ":~$ "
     # sudo doesn't require password
-    def __init__(self, kernel, dtb, image, logger, ram, is_master=False):
+    def __init__(
+        self, kernel, dtb, image, logger, ram, is_master=False, image_format="raw"
+    ):
         self._kernel = kernel
         self._dtb = dtb
         self._image = image
+        self._image_format = image_format
         self._logger = logger
         self._binary = qemu_system_arm_exe_path
         self._is_master = is_master
@@ -129,13 +177,13 @@ class Emulator:
         return _RunningInstance(self, self._logger, cancel_event)
 
     def get_image_size(self):
-        return get_qemu_image_size(self._image, self._logger)
+        return get_qemu_image_size(self._image, self._logger, self._image_format)
 
     def resize_image(self, size, shrink=False):
         subprocess_pretty_check_call(
             [qemu_img_exe_path, "resize"]
             + (["--shrink"] if shrink else [])
-            + ["-f", "raw", self._image, "{}".format(size)],
+            + ["-f", self._image_format, self._image, "{}".format(size)],
             self._logger,
         )
 
@@ -169,25 +217,65 @@ class _RunningInstance:
                 self._qemu.kill()
             raise
 
+    def _open_serial(self, reader_fd):
+        """ prepare reading of QEMU's serial output with timeouts
+
+            uses a selector on the pipe or, as select() only supports sockets
+            on Windows, a single reader thread feeding a queue """
+        self._serial_selector = None
+        self._serial_queue = None
+
+        if os.name == "nt":
+            self._serial_queue = queue.Queue()
+
+            def read_serial():
+                while True:
+                    try:
+                        buf = os.read(reader_fd, 4096)
+                    except OSError:
+                        buf = b""
+                    self._serial_queue.put(buf)
+                    if not buf:
+                        break
+
+            threading.Thread(target=read_serial, daemon=True).start()
+        else:
+            self._serial_selector = selectors.DefaultSelector()
+            self._serial_selector.register(reader_fd, selectors.EVENT_READ)
+
+    def _read_serial(self, reader_fd, deadline):
+        """ next chunk of serial output or None once deadline is reached """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+
+        if self._serial_selector is None:
+            try:
+                return self._serial_queue.get(timeout=remaining)
+            except queue.Empty:
+                return None
+
+        if not self._serial_selector.select(remaining):
+            return None
+        return os.read(reader_fd, 4096)
+
     def _wait_signal(
-        self, reader_fd, writer_fd, signal, timeout, return_buf_states_on_timeout=False
+        self, reader_fd, signal, timeout, return_buf_states_on_timeout=False
     ):
-        timeout_event = threading.Event()
+        """ read serial output until `signal` is found or timeout is reached
 
-        if return_buf_states_on_timeout:
-            buf_states = []
+            signal is matched across chunks boundaries """
+        deadline = time.monotonic() + timeout
+        buf_states = []
+        tail = b""  # end of previous chunks, in case signal is split
 
-        def raise_timeout():
-            timeout_event.set()
-            os.write(writer_fd, b"\nQEMU boot timeout\n")
-
-        ring_buf = collections.deque(maxlen=len(signal))
         while True:
-            timer = threading.Timer(timeout, raise_timeout)
-            timer.start()
-            buf = os.read(reader_fd, 1024)
+            buf = self._read_serial(reader_fd, deadline)
+            if not buf:  # timeout or EOF (qemu exited)
+                if return_buf_states_on_timeout:
+                    return buf_states or [b""]
+                raise QemuException("wait signal timeout: %s" % signal)
 
-            ring_buf.extend(buf)
             if return_buf_states_on_timeout:
                 buf_states.append(buf)
 
@@ -198,16 +286,27 @@ class _RunningInstance:
             else:
                 self._logger.raw_std(decoded_buf)
 
-            if timeout_event.is_set():
-                if return_buf_states_on_timeout:
-                    return buf_states
-                else:
-                    raise QemuException("wait signal timeout: %s" % signal)
+            window = tail + buf
+            if signal in window:
+                return
+            tail = window[-(len(signal) - 1) :] if len(signal) > 1 else b""
 
-            timer.cancel()
+    def _wait_ssh_server(self, ssh_port, timeout):
+        """ wait until guest's SSH daemon sends its banner on forwarded port
 
-            if list(ring_buf) == list(signal):
-                return
+            QEMU accepts connections on the forwarded port before the guest
+            listens so we need to read the SSH identification string """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(("localhost", ssh_port), timeout=5) as s:
+                    s.settimeout(5)
+                    if s.recv(4) == b"SSH-":
+                        return
+            except OSError:
+                pass
+            time.sleep(0.5)
+        raise QemuException("SSH server did not start within %ds" % timeout)
 
     def _boot(self):
         ssh_port = get_free_port()
@@ -235,7 +334,9 @@ class _RunningInstance:
                 "stdio",
                 "-no-acpi",
                 "-drive",
-                "format=raw,if=sd,file={}".format(self._emulation._image),
+                "format={},if=sd,file={}".format(
+                    self._emulation._image_format, self._emulation._image
+                ),
                 "-display",
                 "none",
                 "-no-reboot",
@@ -256,7 +357,8 @@ class _RunningInstance:
             )
             cancel_register.register(self._qemu.pid)
 
-        self._wait_signal(stdout_reader, stdout_writer, b"login: ", timeout)
+        self._open_serial(stdout_reader)
+        self._wait_signal(stdout_reader, b"login: ", timeout)
 
         # start SSH daemon
         if self._emulation._is_master:
@@ -266,9 +368,7 @@ class _RunningInstance:
             tries = 0
             while True:
                 signal = b"Password: "
-                buf_states = self._wait_signal(
-                    stdout_reader, stdout_writer, signal, timeout, True
-                )
+                buf_states = self._wait_signal(stdout_reader, signal, timeout, True)
 
                 if not buf_states:
                     break
@@ -281,16 +381,17 @@ class _RunningInstance:
                 tries += 1
 
             os.write(stdin_writer, b"raspberry\n")
-            self._wait_signal(stdout_reader, stdout_writer, b":~$ ", timeout)
+            self._wait_signal(stdout_reader, b":~$ ", timeout)
             # TODO: This is a ugly hack. But writing all at once doesn't work
             os.write(stdin_writer, b"sudo systemctl")
-            self._wait_signal(stdout_reader, stdout_writer, b"sudo systemctl", timeout)
+            self._wait_signal(stdout_reader, b"sudo systemctl", timeout)
             os.write(stdin_writer, b" start ssh;")
-            self._wait_signal(stdout_reader, stdout_writer, b" start ssh;", timeout)
+            self._wait_signal(stdout_reader, b" start ssh;", timeout)
             os.write(stdin_writer, b" exit\n")
-            self._wait_signal(stdout_reader, stdout_writer, b"login: ", timeout)
+            self._wait_signal(stdout_reader, b"login: ", timeout)
 
-        time.sleep(20)
+        self._logger.std("Waiting for SSH server")
+        self._wait_ssh_server(ssh_port, timeout)
 
         # connect to SSH
         tries = 0
@@ -325,54 +426,71 @@ class _RunningInstance:
             self._qemu.wait(timeout)
         except subprocess.TimeoutExpired:
             self._qemu.terminate()
+            try:
+                self._qemu.wait(30)
+            except subprocess.TimeoutExpired:
+                self._qemu.kill()
+                self._qemu.wait()
         with self._cancel_event.lock() as cancel_register:
             cancel_register.unregister(self._qemu.pid)
+        if self._serial_selector is not None:
+            self._serial_selector.close()
         self._qemu = None
         self._logger.std("VM is off.")
 
-    # The remote path must not exist
+    # The remote path is replaced if it exists
     def put_dir(self, localpath, remotepath):
-        # We first copy to a temporary path we have right on
-        # then we copy to final path with sudo call
-        sftp_client = self._client.open_sftp()
+        # We stream a tar of the tree into a temporary path we have right on
+        # then we move it to final path with sudo call.
+        # a checksum of the tree is stored along so unchanged trees are skipped
+        checksum = get_folder_checksum(localpath)
+        marker_path = posixpath.join(remotepath, PUT_DIR_MARKER_FNAME)
+        remote_checksum = self.exec_cmd(
+            "cat {} 2>/dev/null".format(marker_path),
+            capture_stdout=True,
+            check=False,
+            show_command=False,
+        )
+        if remote_checksum.strip() == checksum:
+            self._logger.std(
+                "{} is up to date in {}, not copying".format(localpath, remotepath)
+            )
+            return
+
         tmpremotepath = "/tmp/" + generate_random_name()
-        sftp_client.mkdir(tmpremotepath)
         self._logger.std(
             "copy local dir {} to tmp dir {}".format(localpath, tmpremotepath)
         )
-
-        old_cwd = os.getcwd()
-        os.chdir(localpath)
-        for localdirpath, dirnames, filenames in os.walk("."):
-            remotedirpath = ""
-            remotedirpath_unformatted = localdirpath
-
-            while remotedirpath_unformatted is not "":
-                remotedirpath_unformatted, tail = os.path.split(
-                    remotedirpath_unformatted
-                )
-                remotedirpath = posixpath.join(tail, remotedirpath)
-
-            for dirname in dirnames:
-                dir_remote_path = posixpath.join(tmpremotepath, remotedirpath, dirname)
-                self._logger.std("make remote dir {}".format(dir_remote_path))
-                sftp_client.mkdir(dir_remote_path)
-
-            for filename in filenames:
-                file_local_path = os.path.normpath(os.path.join(localdirpath, filename))
-                file_remote_path = posixpath.join(
-                    tmpremotepath, remotedirpath, filename
-                )
-                self._logger.std(
-                    "copy local file {} to tmp file {}".format(
-                        file_local_path, file_remote_path
-                    )
+        command = (
+            "mkdir {tmp} && tar -x -C {tmp} && "
+            "sudo /bin/rm -rf {dest} && sudo mv -T {tmp} {dest}".format(
+                tmp=tmpremotepath, dest=remotepath
+            )
+        )
+        self._logger.std(command)
+        stdin, stdout, stderr = self._client.exec_command(command)
+        with tarfile.open(fileobj=stdin, mode="w|") as tar:
+            for entry in sorted(os.listdir(localpath)):
+                tar.add(os.path.join(localpath, entry), arcname=entry)
+            marker = checksum.encode("utf-8")
+            tarinfo = tarfile.TarInfo(PUT_DIR_MARKER_FNAME)
+            tarinfo.size = len(marker)
+            tarinfo.mtime = time.time()
+            tar.addfile(tarinfo, io.BytesIO(marker))
+        stdin.close()
+        stdin.channel.shutdown_write()
+
+        for line in stdout.readlines():
+            self._logger.std(line.replace("\n", ""))
+        for line in stderr.readlines():
+            self._logger.err("STDERR: " + line.replace("\n", ""))
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            raise QemuException(
+                "ssh command failed with status {}. cmd: {}".format(
+                    exit_status, command
                 )
-                sftp_client.put(file_local_path, file_remote_path)
-        sftp_client.close()
-        os.chdir(old_cwd)
-
-        self.exec_cmd("sudo mv -T {} {}".format(tmpremotepath, remotepath))
+            )
 
     # The remote path must be a file
     def put_file(self, localpath, remotepath):
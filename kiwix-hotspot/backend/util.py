@@ -4,18 +4,33 @@
 import os
 import re
 import sys
+import mmap
 import time
+import errno
+import queue
 import shlex
 import signal
 import ctypes
+import struct
+import hashlib
 import tempfile
 import threading
 import subprocess
 
 import data
-from util import CLILogger
+from util import CLILogger, ONE_MiB, human_readable_size
 
 
+# linux ioctl to clone a file using copy-on-write (btrfs, XFS)
+FICLONE = 0x40049409
+# linux ioctl to zero-out a range of a block device
+BLKZEROOUT = 0x127F
+
+# seconds to wait for a file or device to be released by other processes
+RELEASE_TIMEOUT = 60
+# seconds between two checks of a condition we're waiting for
+WAIT_INTERVAL = 0.2
+
 # windows-only flags to prevent sleep on executing thread
 WINDOWS_SLEEP_FLAGS = {
     # Enables away mode. This value must be specified with ES_CONTINUOUS.
@@ -181,36 +196,85 @@ def get_admin_command(command, from_gui, logger, log_to=None):
 
 
 class EtcherWriterThread(threading.Thread):
+    # etcher-cli progress lines: `Flashing [====   ] 42% eta 1m3s`
+    progress_re = re.compile(r"(Flashing|Validating).*?(\d+(?:\.\d+)?)%")
+    # etcher-cli redraws its progress bar with line-up escapes
+    line_sep_re = re.compile(r"\r|\n|\x1b\[1A")
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._should_stop = False  # stop flag
+        self._stop_event = threading.Event()  # set on cancel
+        self._exited = threading.Event()  # set once etcher output is over
         self.exp = None  # exception to be re-raised by caller
+        self._read_exp = None  # exception while reading etcher output
+        self._last_step = None
+        self._last_percent = None
 
     def stop(self):
-        self._should_stop = True
-
-    @classmethod
-    def show_log(cls, logger, log_to_file, log_file, process, eof=False):
-        if log_to_file:
-            try:
-                with open(log_file.name, "r") as f:
-                    lines = f.readlines()
-                    if len(lines) >= 2:
-                        lines.pop()
-                    # working
-                    if "Validating" in lines[-1] or "Flashing" in lines[-1]:
-                        logger.std(lines[-1].replace("\x1b[1A", "").strip())
-                    elif "[1A" in lines[-1]:  # still working but between progress
-                        logger.std(lines[-2].replace("\x1b[1A", "").strip())
-                    else:  # probably at end of file
-                        for line in lines[-5:]:
-                            logger.std(line.replace("\x1b[1A", "").strip())
-            except Exception as exp:
-                logger.err("Failed to read etcher log output: {}".format(exp))
-
-        if not log_to_file or eof:
-            for line in process.stdout:
-                logger.raw_std(line.decode("utf-8", "ignore"))
+        self._stop_event.set()
+        self._exited.set()  # wake run() up
+
+    def handle_line(self, logger, line):
+        """ log a single line of etcher output, parsing progress from it """
+        line = line.strip()
+        if not line:
+            return
+
+        match = self.progress_re.search(line)
+        if match is None:
+            logger.std(line)
+            return
+
+        # flashing is the first half of the stage, validating the second
+        step, percent = match.group(1), int(float(match.group(2)))
+        if step != self._last_step:
+            self._last_step = step
+            self._last_percent = None
+            logger.std(line)
+        elif (
+            self._last_percent is not None and percent // 10 > self._last_percent // 10
+        ):
+            logger.std(line)  # log every 10% to keep track in log files
+        if percent != self._last_percent:
+            self._last_percent = percent
+            offset = 0 if step == "Flashing" else 0.5
+            logger.progress(offset + min(percent, 100) / 200)
+
+    def read_output(self, logger, stream, log_file=None):
+        """ incrementally read etcher output until it completes
+
+            stream is etcher's stdout or, if log_file is set,
+            the log file we tail until etcher (stream's process) exits """
+        try:
+            buffer = ""
+            if log_file is None:
+                for chunk in iter(lambda: stream.read1(4096), b""):
+                    lines = self.line_sep_re.split(
+                        buffer + chunk.decode("utf-8", "ignore")
+                    )
+                    buffer = lines.pop()
+                    for line in lines:
+                        self.handle_line(logger, line)
+            else:
+                process = stream
+                with open(log_file.name, "r", encoding="utf-8") as fh:
+                    while True:
+                        data = fh.read()
+                        if not data:
+                            if process.poll() is not None or self._stop_event.is_set():
+                                break
+                            # no way to be notified of file changes portably
+                            self._stop_event.wait(0.5)
+                            continue
+                        lines = self.line_sep_re.split(buffer + data)
+                        buffer = lines.pop()
+                        for line in lines:
+                            self.handle_line(logger, line)
+            self.handle_line(logger, buffer)
+        except Exception as exp:
+            self._read_exp = exp  # handed back to run()
+        finally:
+            self._exited.set()
 
     def run(self,):
         image_fpath, device_fpath, logger = self._args
@@ -227,26 +291,18 @@ class EtcherWriterThread(threading.Thread):
         )
         logger.std("Starting Etcher: " + str(process.args))
 
-        # intervals in second
-        sleep_interval = 2
-        log_interval = 60
-
-        counter = 0
-        while process.poll() is None:
-            counter += 1
-            if self._should_stop:  # on cancel
-                logger.std(". cancelling...")
-                break
-
-            time.sleep(sleep_interval)
-            # increment sleep counter until we reach log interval
-            if counter < log_interval // sleep_interval:
-                counter += 1
-                continue
+        reader = threading.Thread(
+            target=self.read_output,
+            args=(logger, process if log_to_file else process.stdout, log_file),
+            daemon=True,
+        )
+        reader.start()
+
+        # sleep until etcher is done or we are asked to stop
+        self._exited.wait()
 
-            # reset counter and display log
-            counter = 0
-            self.show_log(logger, log_to_file, log_file, process)
+        if self._stop_event.is_set():  # on cancel
+            logger.std(". cancelling...")
 
         try:
             logger.std(". has process exited?")
@@ -275,9 +331,12 @@ class EtcherWriterThread(threading.Thread):
                 )
 
         # capture last output
-        self.show_log(logger, log_to_file, log_file, process, eof=True)
-
+        reader.join(timeout=2)
+        if self.exp is None and self._read_exp is not None:
+            self.exp = self._read_exp
         if log_to_file:
+            for line in process.stdout:
+                logger.raw_std(line.decode("utf-8", "ignore"))
             log_file.close()
             try:
                 os.unlink(log_file.name)
@@ -288,6 +347,395 @@ class EtcherWriterThread(threading.Thread):
         logger.progress(1)
 
 
+class ImageWriterTarget:
+    """ a device being written to by ImageWriterThread
+
+        blocks are received through a queue, written by a writer thread
+        and read back by a verifier thread """
+
+    def __init__(self, device_fpath, parent):
+        self.device_fpath = device_fpath
+        self.parent = parent
+        self.blocks = queue.Queue(maxsize=64)  # bounds reading ahead (256MiB)
+        self.written_blocks = queue.Queue(maxsize=64)  # bounds verifier lag
+        self.errors = []
+        self.written = 0
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.verifier = threading.Thread(target=self.verify, daemon=True)
+
+    @property
+    def failed(self):
+        return bool(self.errors)
+
+    def fail(self, message):
+        if message not in self.errors:
+            self.errors.append(message)
+
+    def start(self):
+        self.writer.start()
+        self.verifier.start()
+
+    def join(self):
+        self.writer.join()
+        self.verifier.join()
+
+    def zero_range(self, fd, offset, length, buffer):
+        """ fill a range of the device with zeros, without sending them """
+        import fcntl
+
+        try:
+            fcntl.ioctl(fd, BLKZEROOUT, struct.pack("QQ", offset, length))
+        except OSError:  # not a block device or ioctl unsupported
+            buffer.seek(0)
+            buffer.write(bytes(len(buffer)))
+            view = memoryview(buffer)
+            os.lseek(fd, offset, os.SEEK_SET)
+            while length > 0 and not self.failed:
+                length -= os.write(fd, view[: min(length, len(buffer))])
+            view.release()
+
+    def write(self):
+        """ write blocks from queue: (offset, data, digest) or (offset, length) """
+        buffer = mmap.mmap(-1, self.parent.block_size)  # page-aligned for O_DIRECT
+        view = memoryview(buffer)
+        fd = None
+        received_all = False  # whether the end-of-blocks sentinel was consumed
+        try:
+            fd = os.open(self.device_fpath, os.O_WRONLY | os.O_DIRECT | os.O_SYNC)
+            while True:
+                block = self.blocks.get()
+                if block is None:
+                    received_all = True
+                    break
+                if self.failed:
+                    continue  # consume blocks so the reader is not blocked
+                if len(block) == 2:
+                    self.zero_range(fd, *block, buffer)
+                    continue
+
+                offset, data, digest = block
+                view[: len(data)] = data
+                os.lseek(fd, offset, os.SEEK_SET)
+                done = 0
+                while done < len(data):
+                    done += os.write(fd, view[done : len(data)])
+                self.written += len(data)
+                self.written_blocks.put((offset, len(data), digest))
+            os.fsync(fd)
+        except Exception as exp:
+            self.fail(str(exp))
+            # keep consuming until the reader is done
+            while not received_all and self.blocks.get() is not None:
+                pass
+        finally:
+            self.written_blocks.put(None)
+            if fd is not None:
+                os.close(fd)
+            view.release()
+            buffer.close()
+
+    def verify(self):
+        """ read back each (offset, length, digest) from written_blocks queue """
+        buffer = mmap.mmap(-1, self.parent.block_size)  # page-aligned for O_DIRECT
+        view = memoryview(buffer)
+        fd = None
+        try:
+            fd = os.open(self.device_fpath, os.O_RDONLY | os.O_DIRECT)
+            while True:
+                block = self.written_blocks.get()
+                if block is None:
+                    break
+                if self.failed:
+                    continue
+                offset, length, digest = block
+                os.lseek(fd, offset, os.SEEK_SET)
+                read = 0
+                while read < length:
+                    read += os.readv(fd, [view[read:length]])
+                if hashlib.sha256(view[:length]).digest() != digest:
+                    self.fail("data mismatch at offset {}".format(offset))
+        except Exception as exp:
+            self.fail(str(exp))
+            while self.written_blocks.get() is not None:
+                pass
+        finally:
+            if fd is not None:
+                os.close(fd)
+            view.release()
+            buffer.close()
+
+
+class ImageWriterThread(threading.Thread):
+    """ writes an image onto one or several linux block devices (etcher replacement)
+
+        the image is read once and each block is fanned out to every device,
+        each having its own writer and verifier threads (ImageWriterTarget).
+        data is written in large aligned O_DIRECT blocks while the image's
+        holes are zeroed on the device by the kernel (BLKZEROOUT) instead of
+        being read and transferred. each block is hashed as it is read and
+        read back from the devices to verify it. """
+
+    block_size = 4 * ONE_MiB  # must be a multiple of device's sector size
+    sector_size = 512
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stop_event = threading.Event()  # set on cancel
+        self.exp = None  # exception to be re-raised by caller
+        self.targets = []
+
+    def stop(self):
+        self._stop_event.set()
+
+    def align(self, offset):
+        """ offset rounded up to a sector boundary (required by O_DIRECT) """
+        return -(-offset // self.sector_size) * self.sector_size
+
+    @staticmethod
+    def get_data_ranges(fd, size):
+        """ list of (offset, length) of data in file, excluding its holes """
+        ranges = []
+        offset = 0
+        try:
+            while offset < size:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+                end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+                ranges.append((start, end - start))
+                offset = end
+        except OSError as exp:
+            if exp.errno == errno.ENXIO:  # no more data after offset
+                return ranges
+            return [(0, size)]  # SEEK_DATA not supported by filesystem
+        return ranges
+
+    def run(self,):
+        image_fpath, device_fpaths, logger = self._args
+        if isinstance(device_fpaths, str):
+            device_fpaths = [device_fpaths]
+
+        logger.step("Copy image to sd card ({})".format(", ".join(device_fpaths)))
+        self.targets = [ImageWriterTarget(fpath, self) for fpath in device_fpaths]
+        try:
+            self.write(image_fpath, logger)
+        except Exception as exp:
+            self.exp = exp
+        logger.progress(1)
+
+    def send(self, block):
+        """ fan a block out to all valid targets """
+        for target in self.targets:
+            if not target.failed:
+                target.blocks.put(block)
+
+    def report(self, data_size, logger, last_percent):
+        """ update progress with slowest valid target, logging every 10% """
+        active = [target for target in self.targets if not target.failed]
+        if not active:
+            return last_percent
+        written = min([target.written for target in active])
+        logger.progress(written, data_size or 1)
+
+        percent = written * 100 // (data_size or 1)
+        if percent // 10 > last_percent // 10:
+            logger.std(
+                " ".join(
+                    [
+                        "{}: {}%".format(
+                            target.device_fpath,
+                            "failed"
+                            if target.failed
+                            else target.written * 100 // (data_size or 1),
+                        )
+                        for target in self.targets
+                    ]
+                )
+            )
+        return percent
+
+    def write(self, image_fpath, logger):
+        size = os.path.getsize(image_fpath)
+        image_fd = os.open(image_fpath, os.O_RDONLY)
+        try:
+            ranges = self.get_data_ranges(image_fd, size)
+            data_size = sum([length for _, length in ranges])
+            logger.std(
+                "Writing {} of data out of {} image to {} device(s)".format(
+                    human_readable_size(data_size),
+                    human_readable_size(size),
+                    len(self.targets),
+                )
+            )
+            for target in self.targets:
+                target.start()
+
+            percent = 0
+            previous_end = 0
+            for start, length in ranges + [(size, 0)]:
+                # holes are zeroed in whole sectors, as data blocks are padded
+                hole_start, hole_end = self.align(previous_end), self.align(start)
+                if hole_end > hole_start:
+                    self.send((hole_start, hole_end - hole_start))
+                previous_end = start + length
+
+                offset = start
+                while offset < start + length:
+                    if self._stop_event.is_set():
+                        raise CheckCallException("Cancelled")
+                    if all([target.failed for target in self.targets]):
+                        raise CheckCallException("All devices failed")
+                    chunk = min(self.block_size, start + length - offset)
+                    data = os.pread(image_fd, chunk, offset)
+                    # O_DIRECT requires sector-aligned lengths
+                    data += bytes(self.align(len(data)) - len(data))
+                    self.send((offset, data, hashlib.sha256(data).digest()))
+                    offset += chunk
+                    percent = self.report(data_size, logger, percent)
+        finally:
+            for target in self.targets:
+                target.blocks.put(None)
+            logger.std("Waiting for writes and verifications to complete")
+            for target in self.targets:
+                target.join()
+            os.close(image_fd)
+
+        for target in self.targets:
+            if target.failed:
+                logger.err(
+                    "{}: failed: {}".format(
+                        target.device_fpath, "; ".join(target.errors)
+                    )
+                )
+            else:
+                logger.std("{}: written and verified.".format(target.device_fpath))
+
+        failed = [target.device_fpath for target in self.targets if target.failed]
+        if failed:
+            raise CheckCallException(
+                "Failed to write {} of {} device(s): {}".format(
+                    len(failed), len(self.targets), ", ".join(failed)
+                )
+            )
+
+
+def wait_for(condition, timeout=RELEASE_TIMEOUT, interval=WAIT_INTERVAL):
+    """ poll condition() until it is true or timeout (seconds) expires
+
+        returns whether condition was met """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def is_file_in_use(fpath):
+    """ whether fpath is opened by another process
+
+        linux: looks for it in processes' open files (/proc/<pid>/fd)
+        macOS: uses lsof
+        windows: opened files (without delete sharing) can't be renamed """
+    if not os.path.exists(fpath):
+        return False
+
+    if sys.platform == "linux":
+        fpath = os.path.realpath(fpath)
+        own_pid = str(os.getpid())
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit() or pid == own_pid:
+                continue
+            fd_folder = os.path.join("/proc", pid, "fd")
+            try:
+                fds = os.listdir(fd_folder)
+            except OSError:
+                continue  # exited or not ours
+            for fd in fds:
+                try:
+                    if os.readlink(os.path.join(fd_folder, fd)) == fpath:
+                        return True
+                except OSError:
+                    continue
+        return False
+
+    if sys.platform == "darwin":
+        try:
+            return (
+                subprocess.call(
+                    ["/usr/sbin/lsof", "-t", "--", fpath],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+                == 0
+            )
+        except OSError:
+            return False
+
+    try:
+        os.rename(fpath, fpath)
+    except OSError:
+        return True
+    return False
+
+
+def wait_for_file_release(fpath, logger, timeout=RELEASE_TIMEOUT):
+    """ wait until no other process uses fpath (QEMU, aria2c, etc) """
+    if wait_for(lambda: not is_file_in_use(fpath), timeout=timeout):
+        return True
+    logger.err("{} still in use after {}s".format(fpath, timeout))
+    return False
+
+
+def write_sparse(fileobj, dest_fpath, size=None, on_progress=None):
+    """ write a readable binary stream into a file, keeping it sparse
+
+        all-zero blocks are seeked over instead of being written.
+        file is then extended to `size` if it is larger than the stream.
+        on_progress is called with the number of bytes read after each block
+
+        returns the number of bytes read from stream """
+    block_size = ONE_MiB
+    zero_block = bytes(block_size)
+    read = 0
+    with open(dest_fpath, "wb") as dest:
+        for block in iter(lambda: fileobj.read(block_size), b""):
+            if block == zero_block or block == bytes(len(block)):
+                dest.seek(len(block), os.SEEK_CUR)
+            else:
+                dest.write(block)
+            read += len(block)
+            if on_progress is not None:
+                on_progress(read)
+        # sets actual size (trailing zero blocks were only seeked over)
+        dest.truncate(max([read, size or 0]))
+    return read
+
+
+def clone_file(src_fpath, dest_fpath, size=None):
+    """ copy a file, using a copy-on-write clone if filesystem supports it
+
+        falls back to a sparse copy. file is extended to `size` if larger
+
+        returns the method used: `reflink` or `copy` """
+    src_size = os.path.getsize(src_fpath)
+
+    if sys.platform == "linux":
+        import fcntl
+
+        try:
+            with open(src_fpath, "rb") as src, open(dest_fpath, "wb") as dest:
+                fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+                if size is not None and size > src_size:
+                    dest.truncate(size)
+        except OSError:
+            pass  # not supported by filesystem (or cross-device)
+        else:
+            return "reflink"
+
+    with open(src_fpath, "rb") as fileobj:
+        write_sparse(fileobj, dest_fpath, size=size)
+    return "copy"
+
+
 def prevent_sleep(logger):
     if sys.platform == "win32":
         logger.std("Setting ES_SYSTEM_REQUIRED mode to current thread")
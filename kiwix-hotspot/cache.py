@@ -4,7 +4,9 @@
 
 """ manages the cache folder of a supplied build-dir
     - show contents and their status (usable or not)
+    - verify contents against their checksums
     - clean all not usable contents
+    - evict least recently used contents to fit a quota
     - reset the cache folder completely
 """
 
@@ -12,10 +14,13 @@ import os
 import sys
 import argparse
 
+import humanfriendly
+
 from backend.content import CONTENTS
 from util import CLILogger, get_cache
 from backend.catalog import get_catalogs
-from backend.cache import list_cache_files, clean_cache, reset_cache
+from backend.cache import list_cache_files, clean_cache, reset_cache, verify_cache
+from backend.cache import evict_cache
 
 
 def init(logger):
@@ -44,11 +49,36 @@ def main():
     parser_show = subparsers.add_parser("show", help="List files in cache")
     parser_show.set_defaults(func=list_cache_files)
 
+    parser_verify = subparsers.add_parser(
+        "verify", help="Verify checksums of files in cache"
+    )
+    parser_verify.set_defaults(func=verify_cache)
+    parser_verify.add_argument(
+        "--full",
+        help="Re-hash all files, ignoring the checksums index",
+        action="store_true",
+    )
+
     parser_clean = subparsers.add_parser(
         "clean", help="Remove obsolete files from cache"
     )
     parser_clean.set_defaults(func=clean_cache)
 
+    parser_evict = subparsers.add_parser(
+        "evict", help="Remove least recently used files to fit a quota"
+    )
+    parser_evict.set_defaults(func=evict_cache)
+    parser_evict.add_argument(
+        "--max-size",
+        help="Maximum size of the cache folder (ex: 100GB)",
+        type=humanfriendly.parse_size,
+    )
+    parser_evict.add_argument(
+        "--min-free",
+        help="Minimum free space to keep in the cache folder (ex: 20GB)",
+        type=humanfriendly.parse_size,
+    )
+
     parser_reset = subparsers.add_parser("reset", help="Reset cache folder completely")
     parser_reset.set_defaults(func=reset_cache)
     parser_reset.add_argument(
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" compares catalog loading methods: parse time and peak memory (RSS)
+    - yaml: pure-python PyYAML loader (previous behavior)
+    - cyaml: libyaml-based CSafeLoader (if available)
+    - compiled: lazy catalog from the compiled (pickled) cache
+
+    each method runs in a separate process so peak RSS is its own.
+    uses the cached catalog YAML (fetched if needed) or a synthetic one.
+    peak RSS is read from resource (not available on windows)
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import resource
+import subprocess
+
+import yaml
+
+from util import CLILogger, yaml_dump
+from backend.catalog import CATALOGS, get_catalogs, get_catalog_paths
+from backend.catalog import compile_catalog, read_catalog_meta, load_cached_catalog
+
+METHODS = ["yaml", "cyaml", "compiled"]
+
+
+def get_peak_rss():
+    """ peak resident memory of current process in bytes """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def make_synthetic_catalog(fpath, nb_entries):
+    """ write a catalog-like YAML file with nb_entries packages """
+    packages = {}
+    for index in range(nb_entries):
+        package_id = "package{}_{}".format(index, random.choice(["fr", "en", "es"]))
+        packages[package_id] = {
+            "name": "Package {}".format(index),
+            "description": "Description of package number {}".format(index),
+            "version": "2018-{:02d}".format(index % 12 + 1),
+            "language": "eng",
+            "id": package_id,
+            "url": "http://download.kiwix.org/zim/{}.zim".format(package_id),
+            "sha256sum": "{:064x}".format(random.getrandbits(256)),
+            "type": "zim",
+            "langid": package_id,
+            "size": random.randint(2 ** 20, 2 ** 35),
+        }
+    with open(fpath, "w") as fp:
+        yaml_dump({"all": packages}, fp, default_flow_style=False)
+
+
+def run_method(method, yaml_fpath, compiled_paths):
+    """ load the catalog using method
+
+        returns duration, peak RSS, peak RSS increase and nb of entries """
+    initial_rss = get_peak_rss()  # interpreter and imports
+    started_on = time.time()
+    if method == "compiled":
+        catalog = load_cached_catalog(compiled_paths, CLILogger())
+    else:
+        loader = yaml.CSafeLoader if method == "cyaml" else yaml.SafeLoader
+        with open(yaml_fpath, "r") as fp:
+            catalog = yaml.load(fp, Loader=loader)
+    duration = time.time() - started_on
+    peak_rss = get_peak_rss()
+    return duration, peak_rss, peak_rss - initial_rss, len(catalog["all"])
+
+
+def benchmark(yaml_fpath, compiled_paths):
+    """ print duration and memory of each method for this catalog """
+    compile_catalog(compiled_paths, read_catalog_meta(compiled_paths), CLILogger())
+
+    print(
+        "catalog: {} ({:.1f} MiB)".format(
+            yaml_fpath, os.path.getsize(yaml_fpath) / 2 ** 20
+        )
+    )
+    for method in METHODS:
+        if method == "cyaml" and not hasattr(yaml, "CSafeLoader"):
+            print("{:>10}: libyaml not available".format(method))
+            continue
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--method",
+                method,
+                "--yaml",
+                yaml_fpath,
+                "--compiled",
+                json.dumps(compiled_paths),
+            ]
+        )
+        duration, peak_rss, increase, nb_entries = json.loads(
+            output.decode("utf-8").strip()
+        )
+        print(
+            "{:>10}: {:8.3f}s  peak RSS {:8.1f} MiB (+{:.1f} MiB)  ({} entries)".format(
+                method, duration, peak_rss / 2 ** 20, increase / 2 ** 20, nb_entries
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        help="benchmark a synthetic catalog of this many entries instead",
+    )
+    parser.add_argument("--method", choices=METHODS, help=argparse.SUPPRESS)
+    parser.add_argument("--yaml", help=argparse.SUPPRESS)
+    parser.add_argument("--compiled", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.method:  # child process: run a single method
+        compiled_paths = json.loads(args.compiled)
+        print(json.dumps(run_method(args.method, args.yaml, compiled_paths)))
+        return
+
+    if args.synthetic:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            yaml_fpath = os.path.join(tmp_dir, "synthetic.yml")
+            make_synthetic_catalog(yaml_fpath, args.synthetic)
+            benchmark(
+                yaml_fpath,
+                {
+                    "yaml": yaml_fpath,
+                    "meta": os.path.join(tmp_dir, "synthetic.meta.json"),
+                    "compiled": os.path.join(tmp_dir, "synthetic.pickle"),
+                },
+            )
+    else:
+        get_catalogs(CLILogger())  # ensures cached (and compiled) catalog
+        compiled_paths = get_catalog_paths(CATALOGS[0])
+        benchmark(compiled_paths["yaml"], compiled_paths)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,6 @@
 import os
 import sys
 import json
-import yaml
 import time
 import argparse
 import tempfile
@@ -17,6 +16,7 @@ from backend.content import (
     get_required_image_size,
     get_content,
     isremote,
+    COPY_CONCURRENCY,
 )
 from util import CancelEvent
 from util import check_user_inputs
@@ -24,10 +24,11 @@ from version import get_version_str
 from util import CLILogger, b64decode
 from util import get_free_space_in_dir
 from util import get_adjusted_image_size
-from backend.catalog import get_catalogs
+from backend.catalog import get_catalogs, dump_catalog
 from run_installation import run_installation
+from backend.download import DOWNLOAD_CONCURRENCY
 from util import human_readable_size, get_cache
-from backend.util import sd_has_single_partition, is_admin
+from backend.util import sd_has_single_partition, is_admin, RELEASE_TIMEOUT
 
 import tzlocal
 import humanfriendly
@@ -142,8 +143,7 @@ if get_catalogs(logger) is None:
 
 zim_choices = []
 for catalog in get_catalogs(logger):
-    for (key, value) in catalog["all"].items():
-        zim_choices.append(key)
+    zim_choices.extend(catalog["all"])  # package ids (entries are not loaded)
 
 languages = [code for code, language in data.hotspot_languages]
 
@@ -162,6 +162,15 @@ defaults = {
     "wikifundi": [],
     "zim_install": [],
     "shrink": "yes",
+    "concurrent_downloads": DOWNLOAD_CONCURRENCY,
+    "concurrent_copies": COPY_CONCURRENCY,
+    "reuse_master": "no",
+    "qcow2_overlay": "no",
+    "cache_setup": "no",
+    "userspace_exfat": "no",
+    "release_timeout": RELEASE_TIMEOUT,
+    "cache_max_size": None,
+    "cache_min_free": None,
 }
 
 parser = argparse.ArgumentParser(description="kiwix-hotspot installer for raspberrypi.")
@@ -203,7 +212,66 @@ parser.add_argument(
 parser.add_argument("--filename", help="Output file name (without suffix)")
 parser.add_argument("--shrink", help="Shrink image file", choices=["yes", "no"])
 parser.add_argument("--ram", help="Max RAM for QEMU", default="2G")
-parser.add_argument("--sdcard", help="Device to copy image to")
+parser.add_argument(
+    "--concurrent-downloads",
+    help="Number of contents to download at once ({})".format(
+        defaults["concurrent_downloads"]
+    ),
+    type=int,
+)
+parser.add_argument(
+    "--concurrent-copies",
+    help="Number of contents to copy/extract onto data partition at once ({})".format(
+        defaults["concurrent_copies"]
+    ),
+    type=int,
+)
+parser.add_argument(
+    "--release-timeout",
+    help="Seconds to wait for image file or loop device to be released "
+    "by other processes ({})".format(defaults["release_timeout"]),
+    type=int,
+)
+parser.add_argument(
+    "--cache-max-size",
+    help="Before downloading, evict least recently used files from cache "
+    "to keep it under this size (unlimited)",
+)
+parser.add_argument(
+    "--cache-min-free",
+    help="Before downloading, evict least recently used files from cache "
+    "to keep this much free space in it (none)",
+)
+parser.add_argument(
+    "--reuse-master",
+    help="Keep a decompressed master image in cache and clone it on next builds",
+    choices=["yes", "no"],
+)
+parser.add_argument(
+    "--qcow2-overlay",
+    help="Configure image through a qcow2 overlay of the cached master "
+    "(implies --reuse-master)",
+    choices=["yes", "no"],
+)
+parser.add_argument(
+    "--cache-setup",
+    help="Keep a snapshot of the configured image in cache and reuse it "
+    "for identical configurations",
+    choices=["yes", "no"],
+)
+parser.add_argument(
+    "--userspace-exfat",
+    help="Write data partition's exFAT filesystem directly into the image "
+    "(no loop device, mount nor root privileges)",
+    choices=["yes", "no"],
+)
+parser.add_argument(
+    "--max-bandwidth",
+    help="Download speed limit for all contents, per second (ex: 2MB)",
+)
+parser.add_argument(
+    "--sdcard", nargs="+", help="Device(s) to copy image to (all written at once)"
+)
 parser.add_argument(
     "--root",
     action="store_true",
@@ -243,7 +311,8 @@ for key, value in defaults.items():
 
 if args.catalog:
     for catalog in get_catalogs(logger):
-        print(yaml.dump(catalog, default_flow_style=False, default_style=""))
+        # same formatting as before the lazy catalogs
+        print(dump_catalog(catalog, default_style="", allow_unicode=False))
     sys.exit(0)
 
 if args.admin_account:
@@ -261,6 +330,39 @@ except Exception:
 else:
     args.human_size = human_readable_size(args.output_size, False)
 
+# parse requested bandwidth
+if args.max_bandwidth is not None:
+    try:
+        args.max_bandwidth = humanfriendly.parse_size(args.max_bandwidth)
+    except Exception:
+        print("Unable to understand max bandwidth ({})".format(args.max_bandwidth))
+        sys.exit(1)
+
+# parse requested cache quota
+for option in ("cache_max_size", "cache_min_free"):
+    if getattr(args, option) is not None:
+        try:
+            setattr(args, option, humanfriendly.parse_size(getattr(args, option)))
+        except Exception:
+            print(
+                "Unable to understand {} ({})".format(
+                    option.replace("_", " "), getattr(args, option)
+                )
+            )
+            sys.exit(1)
+
+if args.concurrent_downloads < 1:
+    print("Concurrent downloads must be at least 1")
+    sys.exit(1)
+
+if args.concurrent_copies < 1:
+    print("Concurrent copies must be at least 1")
+    sys.exit(1)
+
+if args.release_timeout < 0:
+    print("Release timeout can't be negative")
+    sys.exit(1)
+
 
 # check arguments
 (
@@ -291,13 +393,17 @@ for key, is_valid in {
         print("Invalid argument for `{key}`".format(key=key))
         sys.exit(1)
 
-if args.sdcard and not os.path.exists(args.sdcard):
-    print("SD card device does not exist.")
-    sys.exit(1)
+for sdcard in args.sdcard or []:
+    if not os.path.exists(sdcard):
+        print("SD card device does not exist: {}".format(sdcard))
+        sys.exit(1)
 
-if args.sdcard and not sd_has_single_partition(args.sdcard, logger):
-    print("SD card is not clean (must have a single FAT-like partition). Please wipe.")
-    sys.exit(1)
+    if not sd_has_single_partition(sdcard, logger):
+        print(
+            "SD card {} is not clean (must have a single FAT-like partition). "
+            "Please wipe.".format(sdcard)
+        )
+        sys.exit(1)
 
 # display configuration and offer time to cancel
 print("Configuration:")
@@ -327,7 +433,10 @@ avail_space_in_build_dir = get_free_space_in_dir(args.build_dir)
 try:
     # how much space do we need to build the image?
     space_required_to_build = get_required_building_space(
-        collection, cache_folder, args.output_size
+        collection,
+        cache_folder,
+        args.output_size,
+        "yes" in (args.reuse_master, args.qcow2_overlay),
     )
     # how large should the image be?
     required_image_size = get_required_image_size(collection)
@@ -402,6 +511,16 @@ try:
         filename=args.filename,
         shrink=args.shrink == "yes",
         qemu_ram=args.ram,
+        download_concurrency=args.concurrent_downloads,
+        copy_concurrency=args.concurrent_copies,
+        download_bandwidth=args.max_bandwidth,
+        reuse_master=args.reuse_master == "yes",
+        qcow2_overlay=args.qcow2_overlay == "yes",
+        cache_setup=args.cache_setup == "yes",
+        userspace_exfat=args.userspace_exfat == "yes",
+        release_timeout=args.release_timeout,
+        cache_max_size=args.cache_max_size,
+        cache_min_free=args.cache_min_free,
     )
 except Exception:
     cancel_event.cancel()
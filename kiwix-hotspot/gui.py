@@ -345,6 +345,12 @@ class Application:
         # sd clean
         self.component.clean_sd_button.connect("clicked", self.activate_sd_clean)
 
+        # additional SD-cards to write the image onto
+        self.other_sd_cards = []
+        self.component.sd_card_add_button.connect(
+            "clicked", self.sd_card_add_button_clicked
+        )
+
         # wifi password
         self.component.wifi_password_switch.connect(
             "notify::active",
@@ -1059,8 +1065,8 @@ class Application:
                     "or <b>only remove obsolete files</b>.\n"
                     "Obsoletes files are previous version of ZIMs or content packs.\n\n"
                     "Wiping is almost instantaneous.\n"
-                    "Cleaning takes several minutes as "
-                    "it analyzes files to determine which ones should be kept.\n\n"
+                    "Cleaning analyzes files to determine which ones should be kept "
+                    "(larger caches take longer).\n\n"
                     "Your cache folder is: <i>{cache}</i>.\n"
                     "<u>Cache Disk Usage</u>: <b>{du}</b> ({nb} files)\n"
                     "<u>Free Space</u>: <b>{df}</b>\n".format(
@@ -1717,6 +1723,23 @@ class Application:
         clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
         clipboard.set_text(text_buffer.get_text(start, end, hidden), -1)
 
+    def get_sd_cards(self):
+        """ list of all SD-cards to write onto (selected one first) """
+        sd_card = self.get_sd_card()
+        if sd_card is None:
+            return []
+        return [sd_card] + [
+            device for device in self.other_sd_cards if device != sd_card
+        ]
+
+    def get_sd_card_size(self, device):
+        device_index = sd_card_info.get_device_index()
+        size_index = sd_card_info.get_size_index()
+        for row in self.component.sd_card_list_store:
+            if row[device_index] == device:
+                return int(row[size_index])
+        return -1
+
     def get_sd_card(self):
         if self.component.output_stack.get_visible_child_name() == "sd_card":
             sd_card_id = self.component.sd_card_combobox.get_active()
@@ -1818,6 +1841,17 @@ class Application:
             validate_label(self.component.sd_card_error_label, condition)
             self.component.sd_card_error_label.set_visible(not condition)
             all_valid = all_valid and condition
+
+            # other SD-cards must be clean and large enough for the image
+            condition = all(
+                [
+                    sd_has_single_partition(device, self.logger)
+                    and self.get_sd_card_size(device) >= output_size
+                    for device in self.get_sd_cards()[1:]
+                ]
+            )
+            validate_label(self.component.sd_card_others_label, condition)
+            all_valid = all_valid and condition
         else:
             condition = output_size > 0
             validate_label(self.component.size_label, condition)
@@ -1908,7 +1942,7 @@ class Application:
                     size=output_size,
                     logger=self.logger,
                     cancel_event=self.cancel_event,
-                    sd_card=sd_card,
+                    sd_card=self.get_sd_cards(),
                     logo=logo,
                     favicon=favicon,
                     css=css,
@@ -1928,12 +1962,29 @@ class Application:
     def on_sdcard_selection_change(self, button):
         has_card = self.component.sd_card_combobox.get_active() != -1
         self.component.clean_sd_button.set_visible(has_card)
+        self.component.sd_card_add_button.set_visible(has_card)
 
         # remove warnings on combo change
         validate_label(self.component.sd_card_label, True)
         validate_label(self.component.sd_card_error_label, True)
         self.component.sd_card_error_label.set_visible(False)
 
+    def sd_card_add_button_clicked(self, button):
+        """ toggle presence of selected SD-card in the other SD-cards list """
+        sd_card = self.get_sd_card()
+        if sd_card in self.other_sd_cards:
+            self.other_sd_cards.remove(sd_card)
+        elif sd_card is not None:
+            self.other_sd_cards.append(sd_card)
+        self.update_other_sd_cards_label()
+
+    def update_other_sd_cards_label(self):
+        self.component.sd_card_others_label.set_text(
+            "+ {}".format(", ".join(self.other_sd_cards))
+        )
+        self.component.sd_card_others_label.set_visible(bool(self.other_sd_cards))
+        validate_label(self.component.sd_card_others_label, True)
+
     def sd_card_refresh_button_clicked(self, button):
         self.refresh_disk_list()
         self.update_free_space()
@@ -1957,6 +2008,14 @@ class Application:
             if device_name == selected_device:
                 self.component.sd_card_combobox.set_active(id)
 
+        # forget other SD-cards which have been removed
+        device_index = sd_card_info.get_device_index()
+        devices = [row[device_index] for row in self.component.sd_card_list_store]
+        self.other_sd_cards = [
+            device for device in self.other_sd_cards if device in devices
+        ]
+        self.update_other_sd_cards_label()
+
     def zim_choose_content_button_clicked(self, button):
         if self.ensure_catalogs():
             self.component.zim_window.show()
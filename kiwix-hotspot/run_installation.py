@@ -7,7 +7,10 @@ import time
 import json
 import math
 import shutil
+import queue
+import threading
 import traceback
+import concurrent.futures
 from datetime import datetime
 
 import data
@@ -16,11 +19,13 @@ from util import (
     ONE_GB,
     human_readable_size,
     get_cache,
+    record_cache_usage,
     ensure_zip_exfat_compatible,
     EXFAT_FORBIDDEN_CHARS,
 )
 
 from backend import ansiblecube
+from backend.catalog import CATALOGS, get_catalogs, get_catalog_paths
 from backend.content import (
     get_collection,
     get_content,
@@ -29,22 +34,122 @@ from backend.content import (
     get_content_cache,
     get_alien_content,
     get_required_image_size,
+    get_prepared_master_fname,
+    run_collection_actions,
+    COPY_CONCURRENCY,
+)
+from backend.download import (
+    download_content,
+    download_contents,
+    unzip_file,
+    DOWNLOAD_CONCURRENCY,
 )
-from backend.download import download_content, unzip_file
 from backend.mount import (
     mount_data_partition,
     unmount_data_partition,
     test_mount_procedure,
     format_data_partition,
     guess_next_loop_device,
+    unmount_device_partitions,
+    get_data_partition_extent,
 )
-from backend.util import EtcherWriterThread
+from backend.exfat import ExFATWriter
+from backend.util import EtcherWriterThread, ImageWriterThread, clone_file
+from backend.util import wait_for_file_release, RELEASE_TIMEOUT
+from backend.cache import prepare_master, get_setup_snapshot_path, evict_cache
 from backend.util import prevent_sleep, restore_sleep_policy
 from backend.mount import can_write_on, allow_write_on, restore_mode
 from backend.sysreq import host_matches_requirements, requirements_url
 from backend.homepage import generate_homepage, save_homepage
 
 
+def download_collection(
+    collection,
+    logger,
+    build_dir,
+    cache_folder,
+    edupi_resources,
+    concurrency,
+    bandwidth,
+    stop_event,
+    ready_contents,
+):
+    """ download all contents of collection into cache and check them
+
+        meant to run in background (during setup): progress is reported as
+        the logger's `download` background stage.
+        names of contents are put onto ready_contents (queue.Queue) once in
+        cache then None (or the exception on failure) at the end """
+    try:
+        downloads = list(get_all_contents_for(collection))
+        edupi_content = get_alien_content(edupi_resources) if edupi_resources else None
+
+        def on_complete(content, rf):
+            # edupi resources are announced once checked (below)
+            if rf.successful and (
+                edupi_content is None or content["name"] != edupi_content["name"]
+            ):
+                ready_contents.put(content["name"])
+
+        for dl_content, rf in download_contents(
+            downloads,
+            logger,
+            build_dir,
+            concurrency=concurrency,
+            bandwidth=bandwidth,
+            on_progress=lambda downloaded, total: logger.background_progress(
+                "download", downloaded, total
+            ),
+            on_complete=on_complete,
+            stop_event=stop_event,
+        ):
+            if not rf.successful:
+                logger.err(
+                    "Error downloading {u} to {p}\n{e}".format(
+                        u=dl_content["url"], p=rf.fpath, e=rf.exception
+                    )
+                )
+                raise rf.exception if rf.exception else IOError
+            elif rf.found:
+                logger.std("Reusing already downloaded {p}".format(p=rf.fpath))
+            else:
+                logger.std(
+                    "Saved `{p}` successfuly: {s}".format(
+                        p=dl_content["name"], s=human_readable_size(rf.downloaded_size)
+                    )
+                )
+
+        # check edupi resources compliance
+        if edupi_resources:
+            logger.std("Verifying EduPi resources file names")
+            exfat_compat, exfat_errors = ensure_zip_exfat_compatible(
+                get_content_cache(edupi_content, cache_folder, True)
+            )
+            if not exfat_compat:
+                raise ValueError(
+                    "Your EduPi resources archive is incorrect.\n"
+                    "It should be a ZIP file of a root folder "
+                    "in which all files have exfat-compatible "
+                    "names (no {chars})\n... {fnames}".format(
+                        chars=" ".join(EXFAT_FORBIDDEN_CHARS),
+                        fnames="\n... ".join(exfat_errors),
+                    )
+                )
+            else:
+                logger.std("EduPi resources archive OK")
+                ready_contents.put(edupi_content["name"])
+    except Exception as exp:
+        ready_contents.put(exp)
+        raise
+    ready_contents.put(None)
+
+
+def raise_on_failed_downloads(contents_downloaded):
+    """ raise the exception of background downloads if they failed already """
+    if contents_downloaded.done() and contents_downloaded.exception() is not None:
+        raise contents_downloaded.exception()
+
+
 def run_installation(
     name,
     timezone,
@@ -71,12 +176,25 @@ def run_installation(
     filename=None,
     qemu_ram="2G",
     shrink=False,
+    download_concurrency=DOWNLOAD_CONCURRENCY,
+    download_bandwidth=None,
+    copy_concurrency=COPY_CONCURRENCY,
+    reuse_master=False,
+    qcow2_overlay=False,
+    cache_setup=False,
+    userspace_exfat=False,
+    release_timeout=RELEASE_TIMEOUT,
+    cache_max_size=None,
+    cache_min_free=None,
 ):
 
-    logger.start(bool(sd_card))
+    # sd_card is either a device path or a list of devices to write to
+    sd_cards = [sd_card] if isinstance(sd_card, str) else list(sd_card or [])
+    logger.start(bool(sd_cards))
 
     logger.stage("init")
     cache_folder = get_cache(build_dir)
+    stop_downloads = threading.Event()  # prevents pending downloads from starting
 
     try:
         logger.std("Preventing system from sleeping")
@@ -114,9 +232,13 @@ def run_installation(
         image_final_path = os.path.join(build_dir, filename + ".img")
         image_building_path = os.path.join(build_dir, filename + ".BUILDING.img")
         image_error_path = os.path.join(build_dir, filename + ".ERROR.img")
+        # qcow2 overlay (on top of prepared master) used during setup
+        image_overlay_path = os.path.join(build_dir, filename + ".BUILDING.qcow2")
 
         # loop device mode on linux (for mkfs in userspace)
-        if sys.platform == "linux":
+        # userspace exFAT builds use neither loop devices nor mounts
+        loop_dev, previous_loop_mode = None, None
+        if sys.platform == "linux" and not userspace_exfat:
             loop_dev = guess_next_loop_device(logger)
             if loop_dev and not can_write_on(loop_dev):
                 logger.step("Change loop device mode ({})".format(sd_card))
@@ -169,35 +291,21 @@ def run_installation(
         homepage_path = save_homepage(generate_homepage(logger, ansible_options))
         logger.std("homepage saved to: {}".format(homepage_path))
 
-        # Download Base image
-        logger.stage("master")
-        logger.step("Retrieving base image file")
-
-        rf = download_content(base_image, logger, build_dir)
-        if not rf.successful:
-            logger.err("Failed to download base image.\n{e}".format(e=rf.exception))
-            sys.exit(1)
-        elif rf.found:
-            logger.std("Reusing already downloaded base image ZIP file")
-        logger.progress(0.5)
-
-        # extract base image and rename
-        logger.step("Extracting base image from ZIP file")
-        unzip_file(
-            archive_fpath=rf.fpath,
-            src_fname=base_image["name"].replace(".zip", ""),
-            build_folder=build_dir,
-            dest_fpath=image_building_path,
-        )
-        logger.std("Extraction complete: {p}".format(p=image_building_path))
-        logger.progress(0.9)
-
-        if not os.path.exists(image_building_path):
-            raise IOError("image path does not exists: {}".format(image_building_path))
-
-        logger.step("Testing mount procedure")
-        if not test_mount_procedure(image_building_path, logger, True):
-            raise ValueError("thorough mount procedure failed")
+        # configured image (after phase one) depends only on those
+        # and on the catalogs copied into it (cached YAML files)
+        if cache_setup:
+            get_catalogs(logger)  # ensures catalogs are cached
+            catalog_paths = [get_catalog_paths(catalog)["yaml"] for catalog in CATALOGS]
+            snapshot_fpath = get_setup_snapshot_path(
+                cache_folder,
+                base_image,
+                extra_vars,
+                [data.ansiblecube_path, homepage_path, logo, favicon, css]
+                + [fpath if os.path.exists(fpath) else None for fpath in catalog_paths],
+            )
+            reuse_snapshot = os.path.exists(snapshot_fpath)
+        else:
+            reuse_snapshot = False
 
         # collection contains both downloads and processing callbacks
         # for all requested contents
@@ -212,158 +320,260 @@ def run_installation(
             aflatoun_languages=aflatoun_languages,
         )
 
-        # download contents into cache
-        logger.stage("download")
-        logger.step("Starting all content downloads")
-        downloads = list(get_all_contents_for(collection))
-        archives_total_size = sum([c["archive_size"] for c in downloads])
-        retrieved = 0
-
-        for dl_content in downloads:
-            logger.step(
-                "Retrieving {name} ({size})".format(
-                    name=dl_content["name"],
-                    size=human_readable_size(dl_content["archive_size"]),
-                )
+        # make room in cache before downloading, keeping what this build uses
+        if cache_max_size is not None or cache_min_free is not None:
+            keep = [content["name"] for content in get_all_contents_for(collection)]
+            keep += [base_image["name"], get_prepared_master_fname(base_image)]
+            if cache_setup:
+                keep.append(os.path.basename(snapshot_fpath))
+            if evict_cache(
+                logger,
+                build_dir,
+                cache_folder,
+                max_size=cache_max_size,
+                min_free=cache_min_free,
+                keep=keep,
+            ):
+                logger.err("Cache is over quota, downloads may run out of space")
+
+        # Download Base image
+        logger.stage("master")
+        if reuse_snapshot:
+            logger.step("Cloning configured image snapshot")
+            record_cache_usage(snapshot_fpath)
+            method = clone_file(snapshot_fpath, image_building_path)
+            logger.std(
+                "Clone ({m}) complete: {p}".format(m=method, p=image_building_path)
             )
+        else:
+            logger.step("Retrieving base image file")
 
-            rf = download_content(dl_content, logger, build_dir)
+            rf = download_content(base_image, logger, build_dir)
             if not rf.successful:
-                logger.err(
-                    "Error downloading {u} to {p}\n{e}".format(
-                        u=dl_content["url"], p=rf.fpath, e=rf.exception
-                    )
-                )
-                raise rf.exception if rf.exception else IOError
+                logger.err("Failed to download base image.\n{e}".format(e=rf.exception))
+                sys.exit(1)
             elif rf.found:
-                logger.std("Reusing already downloaded {p}".format(p=rf.fpath))
-            else:
-                logger.std(
-                    "Saved `{p}` successfuly: {s}".format(
-                        p=dl_content["name"], s=human_readable_size(rf.downloaded_size)
-                    )
+                logger.std("Reusing already downloaded base image ZIP file")
+            logger.progress(0.5)
+
+            if reuse_master or qcow2_overlay:
+                # keep a decompressed master in cache and clone it
+                logger.step("Retrieving prepared base image")
+                master_fpath = prepare_master(
+                    base_image, rf.fpath, cache_folder, logger
                 )
-            retrieved += dl_content["archive_size"]
-            logger.progress(retrieved, archives_total_size)
+                logger.progress(0.7)
 
-        # check edupi resources compliance
-        if edupi_resources:
-            logger.step("Verifying EduPi resources file names")
-            exfat_compat, exfat_errors = ensure_zip_exfat_compatible(
-                get_content_cache(
-                    get_alien_content(edupi_resources), cache_folder, True
+                if size < os.path.getsize(master_fpath):
+                    raise ValueError("cannot decrease image size")
+
+            if qcow2_overlay:
+                # setup runs on an overlay ; raw image is created afterwards
+                logger.step(
+                    "Creating a {} qcow2 overlay on top of prepared base image".format(
+                        human_readable_size(size)
+                    )
                 )
-            )
-            if not exfat_compat:
-                raise ValueError(
-                    "Your EduPi resources archive is incorrect.\n"
-                    "It should be a ZIP file of a root folder "
-                    "in which all files have exfat-compatible "
-                    "names (no {chars})\n... {fnames}".format(
-                        chars=" ".join(EXFAT_FORBIDDEN_CHARS),
-                        fnames="\n... ".join(exfat_errors),
+                qemu.create_overlay(master_fpath, image_overlay_path, size, logger)
+            elif reuse_master:
+                logger.step(
+                    "Cloning prepared base image into a {} image".format(
+                        human_readable_size(size)
                     )
                 )
+                method = clone_file(master_fpath, image_building_path, size=size)
+                logger.std(
+                    "Clone ({m}) complete: {p}".format(m=method, p=image_building_path)
+                )
             else:
-                logger.std("EduPi resources archive OK")
+                # extract base image straight into a full-size (sparse) image file
+                logger.step(
+                    "Extracting base image from ZIP file into a {} image".format(
+                        human_readable_size(size)
+                    )
+                )
+                unzip_file(
+                    archive_fpath=rf.fpath,
+                    src_fname=base_image["name"].replace(".zip", ""),
+                    build_folder=build_dir,
+                    dest_fpath=image_building_path,
+                    size=size,
+                    logger=logger,
+                )
+                logger.std("Extraction complete: {p}".format(p=image_building_path))
+        logger.progress(0.9)
 
-        # instanciate emulator
-        logger.stage("setup")
-        logger.step("Preparing qemu VM")
-        emulator = qemu.Emulator(
-            data.vexpress_boot_kernel,
-            data.vexpress_boot_dtb,
-            image_building_path,
-            logger,
-            ram=qemu_ram,
-        )
+        if reuse_snapshot or not qcow2_overlay:
+            if not os.path.exists(image_building_path):
+                raise IOError(
+                    "image path does not exists: {}".format(image_building_path)
+                )
 
-        # Resize image
-        logger.step(
-            "Resizing image file from {s1} to {s2}".format(
-                s1=human_readable_size(emulator.get_image_size()),
-                s2=human_readable_size(size),
-            )
+            if not userspace_exfat:
+                logger.step("Testing mount procedure")
+                if not test_mount_procedure(image_building_path, logger, True):
+                    raise ValueError("thorough mount procedure failed")
+
+        # download contents into cache while the VM is being configured
+        # (setup doesn't use them). contents are copied as they land
+        logger.start_background_stage("download")
+        ready_contents = queue.Queue()
+        logger.std("Starting all content downloads (in background)")
+        downloader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        contents_downloaded = downloader.submit(
+            download_collection,
+            collection=collection,
+            logger=logger,
+            build_dir=build_dir,
+            cache_folder=cache_folder,
+            edupi_resources=edupi_resources,
+            concurrency=download_concurrency,
+            bandwidth=download_bandwidth,
+            stop_event=stop_downloads,
+            ready_contents=ready_contents,
         )
-        if size < emulator.get_image_size():
-            logger.err("cannot decrease image size")
-            raise ValueError("cannot decrease image size")
+        downloader.shutdown(wait=False)
 
-        emulator.resize_image(size)
-
-        # Run emulation
-        logger.step("Starting-up VM (first-time)")
-        with emulator.run(cancel_event) as emulation:
-            # copying ansiblecube again into the VM
-            # should the master-version been updated
-            logger.step("Copy ansiblecube")
-            emulation.exec_cmd(
-                "sudo /bin/rm -rf {}".format(ansiblecube.ansiblecube_path)
+        # instanciate emulator
+        logger.stage("setup")
+        if reuse_snapshot:
+            logger.step("Image configuration restored from snapshot")
+            extra_vars.update(
+                {
+                    "has_custom_branding": ansiblecube.has_custom_branding(
+                        logo=logo, favicon=favicon, css=css
+                    )
+                }
+            )
+        else:
+            logger.step("Preparing qemu VM")
+            emulator = qemu.Emulator(
+                data.vexpress_boot_kernel,
+                data.vexpress_boot_dtb,
+                image_overlay_path if qcow2_overlay else image_building_path,
+                logger,
+                ram=qemu_ram,
+                image_format="qcow2" if qcow2_overlay else "raw",
             )
-            emulation.put_dir(data.ansiblecube_path, ansiblecube.ansiblecube_path)
 
-            logger.step("Run ansiblecube for `resize`")
-            ansiblecube.run(emulation, ["resize"], extra_vars, secret_keys)
+            # Run emulation
+            raise_on_failed_downloads(contents_downloaded)
+            logger.step("Starting-up VM (first-time)")
+            with emulator.run(cancel_event) as emulation:
+                # copying ansiblecube again into the VM
+                # should the master-version been updated
+                logger.step("Copy ansiblecube")
+                emulation.put_dir(data.ansiblecube_path, ansiblecube.ansiblecube_path)
+
+                logger.step("Run ansiblecube for `resize`")
+                ansiblecube.run(emulation, ["resize"], extra_vars, secret_keys)
+
+            raise_on_failed_downloads(contents_downloaded)
+            logger.step("Starting-up VM (second-time)")
+            with emulator.run(cancel_event) as emulation:
+
+                logger.step("Run ansiblecube phase I")
+                ansiblecube.run_phase_one(
+                    emulation,
+                    extra_vars,
+                    secret_keys,
+                    homepage=homepage_path,
+                    logo=logo,
+                    favicon=favicon,
+                    css=css,
+                )
 
-        logger.step("Starting-up VM (second-time)")
-        with emulator.run(cancel_event) as emulation:
+            raise_on_failed_downloads(contents_downloaded)
 
-            logger.step("Run ansiblecube phase I")
-            ansiblecube.run_phase_one(
-                emulation,
-                extra_vars,
-                secret_keys,
-                homepage=homepage_path,
-                logo=logo,
-                favicon=favicon,
-                css=css,
+            # wait for QEMU to release file (windows mostly)
+            # in overlay mode, QEMU used the overlay, not the raw image
+            wait_for_file_release(
+                image_overlay_path if qcow2_overlay else image_building_path,
+                logger,
+                release_timeout,
             )
 
-        # wait for QEMU to release file (windows mostly)
-        time.sleep(10)
+            if qcow2_overlay:
+                logger.step("Flattening qcow2 overlay into raw image")
+                qemu.flatten_image(image_overlay_path, image_building_path, logger)
+                os.unlink(image_overlay_path)
 
-        # mount image's 3rd partition on host
-        logger.stage("copy")
+                if not userspace_exfat:
+                    logger.step("Testing mount procedure")
+                    if not test_mount_procedure(image_building_path, logger, True):
+                        raise ValueError("thorough mount procedure failed")
 
-        logger.step("Formating data partition on host")
-        format_data_partition(image_building_path, logger)
+            if cache_setup:
+                logger.step("Saving configured image snapshot")
+                clone_file(image_building_path, "{}.tmp".format(snapshot_fpath))
+                os.replace("{}.tmp".format(snapshot_fpath), snapshot_fpath)
+                record_cache_usage(snapshot_fpath)
+                logger.std("Snapshot saved to {}".format(snapshot_fpath))
 
-        logger.step("Mounting data partition on host")
-        # copy contents from cache to mount point
-        try:
-            mount_point, device = mount_data_partition(image_building_path, logger)
-            logger.step("Processing downloaded content onto data partition")
-            expanded_total_size = sum([c["expanded_size"] for c in downloads])
-            processed = 0
+        # emulator for remaining operations on the raw image
+        emulator = qemu.Emulator(
+            data.vexpress_boot_kernel,
+            data.vexpress_boot_dtb,
+            image_building_path,
+            logger,
+            ram=qemu_ram,
+        )
 
-            for category, content_dl_cb, content_run_cb, cb_kwargs in collection:
+        # mount image's 3rd partition on host (VM is off)
+        # and copy contents onto it as their downloads complete
+        logger.stage("copy")
 
-                logger.step("Processing {cat}".format(cat=category))
-                content_run_cb(
-                    cache_folder=cache_folder,
-                    mount_point=mount_point,
-                    logger=logger,
-                    **cb_kwargs
+        if userspace_exfat:
+            # build exFAT filesystem straight into the image file
+            logger.step("Writing data partition from userspace")
+            offset, part_size = get_data_partition_extent(image_building_path, logger)
+            with ExFATWriter(
+                image_building_path,
+                offset,
+                part_size,
+                data.data_partition_label,
+                logger,
+            ) as writer:
+                logger.step("Processing downloaded content onto data partition")
+                run_collection_actions(
+                    collection,
+                    cache_folder,
+                    writer.root,
+                    logger,
+                    concurrency=copy_concurrency,
+                    ready_contents=ready_contents,
                 )
-                # size of expanded files for this category (for progress)
-                processed += sum(
-                    [c["expanded_size"] for c in content_dl_cb(**cb_kwargs)]
-                )
-                logger.progress(processed, expanded_total_size)
-        except Exception as exp:
-            try:
-                unmount_data_partition(mount_point, device, logger)
-            except NameError:
-                pass  # if mount_point or device are not defined
-            raise exp
+        else:
+            logger.step("Formating data partition on host")
+            format_data_partition(image_building_path, logger)
 
-        time.sleep(10)
+            logger.step("Mounting data partition on host")
+            # copy contents from cache to mount point
+            try:
+                mount_point, device = mount_data_partition(image_building_path, logger)
+                logger.step("Processing downloaded content onto data partition")
+                run_collection_actions(
+                    collection,
+                    cache_folder,
+                    mount_point,
+                    logger,
+                    concurrency=copy_concurrency,
+                    ready_contents=ready_contents,
+                )
+            except Exception as exp:
+                try:
+                    unmount_data_partition(mount_point, device, logger, release_timeout)
+                except NameError:
+                    pass  # if mount_point or device are not defined
+                raise exp
 
-        # unmount partition
-        logger.step("Unmounting data partition")
-        unmount_data_partition(mount_point, device, logger)
+            # unmount partition (waits for it to be released)
+            logger.step("Unmounting data partition")
+            unmount_data_partition(mount_point, device, logger, release_timeout)
+            wait_for_file_release(image_building_path, logger, release_timeout)
 
-        time.sleep(10)
+        contents_downloaded.result()  # all done (raised through ready_contents)
+        logger.end_background_stage("download")
 
         # rerun emulation for discovery
         logger.stage("move")
@@ -386,9 +596,10 @@ def run_installation(
 
         # wait for QEMU to release file (windows mostly)
         logger.succ("Image creation successful.")
-        time.sleep(20)
+        wait_for_file_release(image_building_path, logger, release_timeout)
 
     except Exception as e:
+        stop_downloads.set()
         logger.failed(str(e))
 
         # display traceback on logger
@@ -399,6 +610,8 @@ def run_installation(
         # Set final image filename
         if os.path.isfile(image_building_path):
             os.rename(image_building_path, image_error_path)
+        if os.path.isfile(image_overlay_path):
+            os.unlink(image_overlay_path)
 
         error = e
     else:
@@ -419,30 +632,44 @@ def run_installation(
                     logger.std("Renamed image file to {}".format(image_final_path))
                     break
 
-            # Write image to SD Card
-            if sd_card:
+            # Write image to SD Card(s)
+            if sd_cards:
                 logger.stage("write")
-                logger.step("Writting image to SD-card ({})".format(sd_card))
+                logger.step(
+                    "Writting image to SD-card ({})".format(", ".join(sd_cards))
+                )
 
+                previous_sd_modes = {}
                 try:
-
-                    etcher_writer = EtcherWriterThread(
-                        args=(image_final_path, sd_card, logger)
-                    )
-                    cancel_event.register_thread(thread=etcher_writer)
-                    etcher_writer.start()
-                    etcher_writer.join(timeout=2)  # make sure it started
-                    while etcher_writer.is_alive():
-                        pass
-                    logger.std("not alive")
-                    etcher_writer.join(timeout=2)
-                    cancel_event.unregister_thread()
-                    if etcher_writer.exp is not None:
-                        raise etcher_writer.exp
+                    # linux writes natively to all cards at once,
+                    # others go through etcher-cli, one card after the other
+                    if sys.platform == "linux":
+                        for device in sd_cards:
+                            unmount_device_partitions(device, logger)
+                            if not can_write_on(device):
+                                previous_sd_modes[device] = allow_write_on(
+                                    device, logger
+                                )
+                        writers_args = [(image_final_path, sd_cards, logger)]
+                        writer_class = ImageWriterThread
+                    else:
+                        writers_args = [
+                            (image_final_path, device, logger) for device in sd_cards
+                        ]
+                        writer_class = EtcherWriterThread
+
+                    for writer_args in writers_args:
+                        image_writer = writer_class(args=writer_args)
+                        cancel_event.register_thread(thread=image_writer)
+                        image_writer.start()
+                        image_writer.join()
+                        cancel_event.unregister_thread()
+                        if image_writer.exp is not None:
+                            raise image_writer.exp
 
                     logger.std("Done writing and verifying.")
-                    time.sleep(5)
-                except Exception:
+                except Exception as exp:
+                    logger.err(str(exp))
                     logger.succ("Image created successfuly.")
                     logger.err(
                         "Writing or verification of Image to your SD-card failed.\n"
@@ -450,6 +677,9 @@ def run_installation(
                         "onto your SD-card. See File menu for links to Etcher."
                     )
                     raise Exception("Failed to write Image to SD-card")
+                finally:
+                    for device, previous_sd_mode in previous_sd_modes.items():
+                        restore_mode(device, previous_sd_mode, logger)
 
         except Exception as e:
             logger.failed(str(e))
@@ -0,0 +1,61 @@
+import os
+
+from util import CLILogger
+from backend.util import ImageWriterThread
+
+ONE_MiB = 2 ** 20
+
+
+class QuietLogger(CLILogger):
+    def std(self, std, end=None):
+        pass
+
+    def step(self, step, end=None):
+        pass
+
+    def err(self, err, end=None):
+        pass
+
+    def progress(self, numerator, denominator=1):
+        pass
+
+
+def write_image(image_fpath, device_fpath, timeout=60):
+    writer = ImageWriterThread(
+        args=(str(image_fpath), str(device_fpath), QuietLogger())
+    )
+    writer.start()
+    writer.join(timeout)
+    assert not writer.is_alive(), "writer thread is hung"
+    return writer
+
+
+def test_unaligned_hole_is_zeroed(tmp_path):
+    image_fpath, device_fpath = tmp_path / "image.img", tmp_path / "device.img"
+    data = os.urandom(ONE_MiB)
+    with open(image_fpath, "wb") as fh:
+        fh.write(data)
+        fh.truncate(3 * ONE_MiB + 100)  # trailing hole ends off a sector
+    device_fpath.write_bytes(b"\xff" * 4 * ONE_MiB)
+
+    writer = write_image(image_fpath, device_fpath)
+
+    assert writer.exp is None
+    written = device_fpath.read_bytes()
+    assert written[:ONE_MiB] == data
+    assert written[ONE_MiB : 3 * ONE_MiB + 512] == bytes(2 * ONE_MiB + 512)
+
+
+def test_fsync_failure_does_not_hang(tmp_path, monkeypatch):
+    image_fpath, device_fpath = tmp_path / "image.img", tmp_path / "device.img"
+    image_fpath.write_bytes(os.urandom(ONE_MiB))
+    device_fpath.write_bytes(bytes(ONE_MiB))
+
+    def failing_fsync(fd):
+        raise OSError(5, "Input/output error")
+
+    monkeypatch.setattr(os, "fsync", failing_fsync)
+    writer = write_image(image_fpath, device_fpath)
+
+    assert writer.exp is not None
+    assert writer.targets[0].failed
@@ -0,0 +1,59 @@
+import bz2
+import io
+import os
+import random
+
+from backend import parallel_bz2
+from backend.parallel_bz2 import ParallelBZ2Reader
+
+ORIGINAL_ITER_SEGMENTS = parallel_bz2.iter_segments
+
+
+def get_data(size=8000000):
+    """ compressible data spanning several bzip2 blocks """
+    rand = random.Random(1)
+    words = [b"hello ", b"world ", b"kiwix ", os.urandom(4)]
+    return b"".join(rand.choice(words) for _ in range(size // 4))[:size]
+
+
+def split_first_block(is_block):
+    """ iter_segments splitting first block in two, as a false-positive magic
+        (block or end-of-stream) inside its compressed data would """
+
+    def iter_segments(fileobj):
+        first = True
+        for value, length, segment_is_block in ORIGINAL_ITER_SEGMENTS(fileobj):
+            if segment_is_block and first:
+                first = False
+                cut = length // 2
+                yield value >> (length - cut), cut, True
+                yield value & ((1 << (length - cut)) - 1), length - cut, is_block
+            else:
+                yield value, length, segment_is_block
+
+    return iter_segments
+
+
+def decompress(data):
+    reader = ParallelBZ2Reader(io.BytesIO(bz2.compress(data)), workers=4)
+    try:
+        return reader.read()
+    finally:
+        reader.close()
+
+
+def test_decompress():
+    data = get_data()
+    assert decompress(data) == data
+
+
+def test_false_block_magic(monkeypatch):
+    monkeypatch.setattr(parallel_bz2, "iter_segments", split_first_block(True))
+    data = get_data()
+    assert decompress(data) == data
+
+
+def test_false_end_of_stream_magic(monkeypatch):
+    monkeypatch.setattr(parallel_bz2, "iter_segments", split_first_block(False))
+    data = get_data()
+    assert decompress(data) == data
@@ -5,6 +5,7 @@ import os
 import re
 import sys
 import json
+import time
 import data
 import signal
 import base64
@@ -26,6 +27,7 @@ except AttributeError:
 
     scandir_func = scandir.scandir
 
+import yaml
 import pytz
 from path import Path
 import humanfriendly
@@ -40,6 +42,15 @@ ONE_GiB = 2 ** 30
 ONE_GB = int(1e9)
 EXFAT_FORBIDDEN_CHARS = ["/", "\\", ":", "*", "?", '"', "<", ">", "|"]
 PREFERENCES = None
+CHECKSUMS_INDEX_FNAME = ".checksums.json"
+CHECKSUMS_INDEX_LOCK = threading.Lock()
+CACHE_USAGE_FNAME = ".usage.json"  # last use of each cache file (for eviction)
+CACHE_USAGE_LOCK = threading.Lock()
+# libyaml-based (C) loader and dumper are much faster, when available
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+# files in the cache folder which are not contents
+CACHE_METADATA_FNAMES = [CHECKSUMS_INDEX_FNAME, CACHE_USAGE_FNAME]
 
 
 STAGES = collections.OrderedDict(
@@ -83,6 +94,8 @@ class ProgressHelper(object):
         self.started_on = datetime.datetime.now()  # when the process started
         self.ended_on = None  # when it ended
         self.durations = {}  # records timedeltas for every ran stages
+        # stages running alongside the current one: started_on, last percentage
+        self.background_stages = {}
 
     def start(self, will_write):
         """ record logger start.
@@ -112,6 +125,36 @@ class ProgressHelper(object):
         self.stage_started_on = datetime.datetime.now()
         self.update()
 
+    def start_background_stage(self, stage_id):
+        """ record start of a stage running alongside the current one
+
+            background stages don't change the current stage nor its progress """
+        self.background_stages[stage_id] = [datetime.datetime.now(), None]
+
+    def background_progress(self, stage_id, numerator, denominator=1):
+        """ log progress of a background stage (every 10%) """
+        if stage_id not in self.background_stages:
+            return
+        try:
+            percentage = int(numerator * 10 / denominator) * 10
+        except ZeroDivisionError:
+            percentage = 100
+        if percentage != self.background_stages[stage_id][1]:
+            self.background_stages[stage_id][1] = percentage
+            self.std(
+                "[{stage}: {pc}%]".format(
+                    stage=self.get_stage_name(stage_id), pc=percentage
+                )
+            )
+
+    def end_background_stage(self, stage_id):
+        """ record duration of a background stage """
+        if stage_id not in self.background_stages:
+            return
+        started_on = self.background_stages.pop(stage_id)[0]
+        ended_on = datetime.datetime.now()
+        self.durations[stage_id] = (started_on, ended_on, ended_on - started_on)
+
     def progress(self, numerator, denominator=1):
         """ record progress for the current stage """
         if numerator is not None:
@@ -217,11 +260,15 @@ class ProgressHelper(object):
     def complete(self):
         """ mark the logger as complete (successful) """
         self.clean_up_stage()
+        for stage_id in list(self.background_stages.keys()):
+            self.end_background_stage(stage_id)
         self.stop()
 
     def failed(self):
         """ mark the logger as complete (failure) """
         self.clean_up_stage()
+        for stage_id in list(self.background_stages.keys()):
+            self.end_background_stage(stage_id)
         self.stop()
 
     def update(self):
@@ -257,6 +304,16 @@ class ProgressHelper(object):
             )
         )
 
+        # stages ran in background overlap others
+        overlap = (
+            sum([data[2].total_seconds() for data in self.durations.values()])
+            - duration.total_seconds()
+        )
+        if overlap > 0:
+            self.std(
+                "OVERLAPPING STAGES: {}".format(humanfriendly.format_timespan(overlap))
+            )
+
 
 def get_free_space_in_dir(dirname):
     """Return folder/drive free space."""
@@ -391,14 +448,176 @@ class CLILogger(ProgressHelper):
         )
 
 
-def get_checksum(fpath, func=hashlib.sha256):
+def get_checksum(fpath, func=hashlib.sha256, force=False):
+    """ hex digest of a file's content
+
+        SHA-256 sums of files in a cache folder are recorded into (and read
+        from) its checksums index so unchanged files are hashed only once.
+        `force` ignores the index and re-hashes the file """
+    indexed = func == hashlib.sha256
+    if indexed and not force:
+        checksum = get_indexed_checksum(fpath)
+        if checksum is not None:
+            return checksum
+
     h = func()
     with open(fpath, "rb") as f:
         for chunk in iter(lambda: f.read(ONE_MiB * 8), b""):
             h.update(chunk)
+    checksum = h.hexdigest()
+
+    if indexed:
+        update_checksums_index(fpath, checksum)
+    return checksum
+
+
+def get_folder_checksum(path, func=hashlib.sha256):
+    """ hex digest of a folder's tree (relative paths and files content) """
+    h = func()
+    for dirpath, dirnames, fnames in os.walk(path):
+        dirnames.sort()  # walk in a predictable order
+        for fname in sorted(fnames):
+            fpath = os.path.join(dirpath, fname)
+            relpath = os.path.relpath(fpath, path).replace(os.sep, "/")
+            h.update(
+                "\0{}\0{}\0".format(relpath, os.path.getsize(fpath)).encode("utf-8")
+            )
+            with open(fpath, "rb") as f:
+                for chunk in iter(lambda: f.read(ONE_MiB * 8), b""):
+                    h.update(chunk)
     return h.hexdigest()
 
 
+def get_cache_metadata_path(fpath, metadata_fname):
+    """ path to a metadata file for a file (None if not in a cache) """
+    folder = os.path.dirname(os.path.abspath(fpath))
+    if os.path.basename(folder) != cache_folder_name:
+        return None
+    return os.path.join(folder, metadata_fname)
+
+
+def get_checksums_index_path(fpath):
+    """ path to the checksums index for a file (None if not in a cache) """
+    return get_cache_metadata_path(fpath, CHECKSUMS_INDEX_FNAME)
+
+
+def read_checksums_index(index_fpath):
+    """ {fname: {size, mtime, inode, sha256}} dict from an index file """
+    try:
+        with open(index_fpath, "r") as fd:
+            return json.load(fd)
+    except Exception:
+        return {}
+
+
+def get_file_signature(fpath):
+    """ stat-based dict identifying a file version (for checksums index) """
+    stat = os.stat(fpath)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "inode": stat.st_ino}
+
+
+def get_indexed_checksum(fpath):
+    """ SHA-256 of fpath from index if file is unchanged since recorded """
+    index_fpath = get_checksums_index_path(fpath)
+    if index_fpath is None:
+        return None
+
+    entry = read_checksums_index(index_fpath).get(os.path.basename(fpath))
+    if entry is None:
+        return None
+
+    try:
+        signature = get_file_signature(fpath)
+    except OSError:
+        return None
+    if any([entry.get(key) != value for key, value in signature.items()]):
+        return None
+    return entry.get("sha256")
+
+
+def update_checksums_index(fpath, checksum):
+    """ record a file's SHA-256 into its folder's checksums index
+
+        index is rewritten atomically (temp file then replace) and its
+        entries for vanished files are dropped """
+    index_fpath = get_checksums_index_path(fpath)
+    if index_fpath is None:
+        return
+
+    with CHECKSUMS_INDEX_LOCK:
+        index = get_live_entries(index_fpath, read_checksums_index(index_fpath))
+        entry = get_file_signature(fpath)
+        entry.update({"sha256": checksum})
+        index[os.path.basename(fpath)] = entry
+        write_cache_metadata(index_fpath, index)
+
+
+def get_live_entries(metadata_fpath, entries):
+    """ entries of a cache metadata dict whose file still exists """
+    folder = os.path.dirname(metadata_fpath)
+    return {
+        fname: entry
+        for fname, entry in entries.items()
+        if os.path.exists(os.path.join(folder, fname))
+    }
+
+
+def write_cache_metadata(metadata_fpath, entries):
+    """ atomically write a cache metadata dict (temp file then replace) """
+    try:
+        with tempfile.NamedTemporaryFile(
+            "w",
+            dir=os.path.dirname(metadata_fpath),
+            prefix=os.path.basename(metadata_fpath),
+            delete=False,
+        ) as fd:
+            json.dump(entries, fd, indent=4)
+        os.replace(fd.name, metadata_fpath)
+    except OSError as exp:
+        print("Failed to save cache metadata {}: {}".format(metadata_fpath, exp))
+        try:
+            os.unlink(fd.name)
+        except Exception:
+            pass
+
+
+def read_cache_usage(cache_folder):
+    """ {fname: timestamp} of last use of cache files """
+    try:
+        with open(os.path.join(cache_folder, CACHE_USAGE_FNAME), "r") as fd:
+            return json.load(fd)
+    except Exception:
+        return {}
+
+
+def record_cache_usage(fpath):
+    """ record that a cache file has just been used (downloaded or reused)
+
+        entries for vanished files are dropped """
+    usage_fpath = get_cache_metadata_path(fpath, CACHE_USAGE_FNAME)
+    if usage_fpath is None:
+        return
+
+    with CACHE_USAGE_LOCK:
+        usage = get_live_entries(
+            usage_fpath, read_cache_usage(os.path.dirname(usage_fpath))
+        )
+        usage[os.path.basename(fpath)] = time.time()
+        write_cache_metadata(usage_fpath, usage)
+
+
+def is_cache_metadata(fname):
+    """ whether a file in the cache folder is our own metadata (not content) """
+    return any([fname.startswith(prefix) for prefix in CACHE_METADATA_FNAMES])
+
+
+def get_cache_fnames(cache_folder):
+    """ list of content file names in the cache folder """
+    return [
+        fname for fname in os.listdir(cache_folder) if not is_cache_metadata(fname)
+    ]
+
+
 def get_cache(build_folder):
     fpath = os.path.join(build_folder, cache_folder_name)
     os.makedirs(fpath, exist_ok=True)
@@ -542,6 +761,16 @@ def split_proxy(proxy_url):
     return netloc, port
 
 
+def yaml_load(stream):
+    """ parsed YAML document (str or file) using the fastest safe loader """
+    return yaml.load(stream, Loader=YAML_LOADER)
+
+
+def yaml_dump(data, stream=None, **kwargs):
+    """ YAML representation of data using the fastest safe dumper """
+    return yaml.dump(data, stream, Dumper=YAML_DUMPER, **kwargs)
+
+
 def get_prefs_path():
     """ full path to our preferences JSON file """
     fname = "kiwix-hotspot.prefs"